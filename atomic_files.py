@@ -0,0 +1,16 @@
+import json
+import os
+
+# files that other processes read while they are written (caches, queue files, reports, live status) are written to
+# a tmp file next to them and renamed into place, so readers never see a partially written file
+
+
+def write_atomic(filename, content):
+    tmp_file = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp_file, "w") as fi:
+        fi.write(content)
+    os.replace(tmp_file, filename)
+
+
+def write_json(data, filename, indent=None):
+    write_atomic(filename, json.dumps(data, indent=indent))
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+benchmarks of the python orchestration layer of the tracula bids app
+generates a synthetic bids dataset, freesurfer folders and a tracula output tree in work_dir, puts fast stub
+executables (trac-all, bids-validator, run_freesurfer.py) on PATH and reports wall time, cpu time and memory of
+each phase. The stubs do no processing, so the timings are the overhead of the app itself. E.g.:
+    python benchmarks/run_benchmarks.py /tmp/tracula_bench --n_subjects 10000 --json_report bench.json
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout, redirect_stderr
+from glob import glob
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import run
+from bids_index import load_bids_index, get_subjects, run_bids_validator
+from tracula import TRACTS, check_minimal_data_reqs, get_data, create_dmrirc, TracTaskGraph
+
+PHASES = ["validator", "check_data", "create_dmrirc", "participant", "task_graph", "group1", "group2"]
+
+PATHSTATS_MEASURES = ["Count", "Volume", "Len_Min", "Len_Max", "Len_Avg", "Len_Center", "AD_Avg", "AD_Avg_Weight",
+                      "AD_Avg_Center", "RD_Avg", "RD_Avg_Weight", "RD_Avg_Center", "MD_Avg", "MD_Avg_Weight",
+                      "MD_Avg_Center", "FA_Avg", "FA_Avg_Weight", "FA_Avg_Center"]
+
+# stub of trac-all: writes job files with one command per session (prep, bedp.pre, bedp.post, path) and
+# n_slices commands per session (bedp); -stat writes one file per tract of pathlist. Job file commands run "true".
+TRAC_ALL_STUB = r'''#!{python}
+import os
+import re
+import sys
+
+args = sys.argv[1:]
+stage = args[0][1:]
+with open(args[args.index("-c") + 1]) as fi:
+    dmrirc = fi.read()
+
+
+def get_list(name):
+    m = re.search(r"set " + name + r" = \(([^)]*)\)", dmrirc)
+    return list(dict.fromkeys(m.group(1).split())) if m else []
+
+
+dtroot = re.search(r"set dtroot = (\S+)", dmrirc).group(1)
+bases = get_list("baselist")
+dirs = [os.path.join(dtroot, s + (".long." + bases[0] if bases else "")) for s in get_list("subjlist")]
+if stage == "stat":
+    os.makedirs(os.path.join(dtroot, "stats"), exist_ok=True)
+    for tract in get_list("pathlist") or {tracts}:
+        with open(os.path.join(dtroot, "stats", tract + ".avg33_mni_bbr.FA.txt"), "w") as fi:
+            fi.write("\n".join(get_list("subjlist")))
+    sys.exit(0)
+
+jobs_dir = os.path.dirname(args[args.index("-jobs") + 1])
+if stage == "prep":
+    jobs = {{"prep": ";".join(["true " + d + "/dmri" for d in dirs] +
+                             ["true " + os.path.join(dtroot, b) for b in bases])}}
+elif stage == "bedp":
+    jobs = {{"bedp.pre": "\n".join("true " + d + "/dmri" for d in dirs),
+            "bedp": "\n".join("true {{}}/dmri.bedpostX {{}}".format(d, i) for d in dirs for i in range({n_slices})),
+            "bedp.post": "\n".join("true " + d + "/dmri.bedpostX" for d in dirs)}}
+else:
+    jobs = {{"path": "\n".join("true " + d + "/dpath" for d in dirs)}}
+for job_name, cmds in jobs.items():
+    with open(os.path.join(jobs_dir, job_name + ".txt"), "w") as fi:
+        fi.write(cmds)
+'''
+
+# bids-validator and run_freesurfer.py are only called to check that the app calls them; freesurfer folders are
+# generated upfront
+SHELL_STUB = "#!/bin/sh\nexit 0\n"
+
+
+def touch(filename, content=""):
+    with open(filename, "w") as fi:
+        fi.write(content)
+
+
+def get_session_labels(n_sessions):
+    # with n_sessions = 0 the dataset has no session folders
+    return ["{}".format(s + 1) for s in range(n_sessions)]
+
+
+def make_bids_dataset(bids_dir, subjects, sessions, n_runs, n_volumes):
+    # empty images; bvecs and bvals with n_volumes entries per run
+    os.makedirs(bids_dir)
+    touch(os.path.join(bids_dir, "dataset_description.json"),
+          json.dumps({"Name": "tracula benchmark", "BIDSVersion": "1.0.2"}))
+    bvals = " ".join(["0"] + ["1000"] * (n_volumes - 1)) + "\n"
+    bvecs = "\n".join(" ".join("{:.4f}".format(random.random()) for _ in range(n_volumes)) for _ in range(3)) + "\n"
+    for subject in subjects:
+        for session in sessions or [""]:
+            session_dir = os.path.join(bids_dir, "sub-" + subject, "ses-" + session if session else "")
+            prefix = "sub-" + subject + ("_ses-" + session if session else "")
+            os.makedirs(os.path.join(session_dir, "anat"))
+            os.makedirs(os.path.join(session_dir, "dwi"))
+            touch(os.path.join(session_dir, "anat", prefix + "_T1w.nii.gz"))
+            for r in range(n_runs):
+                run_prefix = os.path.join(session_dir, "dwi", "{}_run-{}_dwi".format(prefix, r + 1))
+                touch(run_prefix + ".nii.gz")
+                touch(run_prefix + ".bvec", bvecs)
+                touch(run_prefix + ".bval", bvals)
+
+
+def make_freesurfer_dir(freesurfer_dir, subjects, sessions):
+    # recon-all.done of the cross sectional, base and longitudinal freesurfer subjects
+    for subject in subjects:
+        names = ["sub-" + subject]
+        if len(sessions) > 1:
+            names += ["sub-{}_ses-{}".format(subject, s) for s in sessions]
+            names += ["sub-{0}_ses-{1}.long.sub-{0}".format(subject, s) for s in sessions]
+        for name in names:
+            os.makedirs(os.path.join(freesurfer_dir, name, "scripts"))
+            touch(os.path.join(freesurfer_dir, name, "scripts", "recon-all.done"))
+
+
+def make_output_tree(output_dir, subjects, sessions):
+    # participant level results: motion file and pathstats files of all tracts of all subjects (and sessions)
+    for subject in subjects:
+        if len(sessions) > 1:
+            os.makedirs(os.path.join(output_dir, "sub-" + subject))
+            session_dirs = [os.path.join(output_dir, "sub-{0}_ses-{1}.long.sub-{0}".format(subject, s))
+                            for s in sessions]
+        else:
+            session_dirs = [os.path.join(output_dir, "sub-" + subject)]
+        for session_dir in session_dirs:
+            os.makedirs(os.path.join(session_dir, "dmri"))
+            touch(os.path.join(session_dir, "dmri", "dwi_motion.txt"),
+                  "AvgTranslation AvgRotation PercentBadSlices AvgDropoutScore\n{:.4f} {:.4f} {} {:.4f}\n".format(
+                      random.random(), random.random(), random.randint(0, 3), 1 + random.random()))
+            for tract in TRACTS:
+                tract_dir = os.path.join(session_dir, "dpath", tract + "_PP_avg33_mni_bbr")
+                os.makedirs(tract_dir)
+                lines = ["# Title Pathway Statistics", "#", "# pathwayname " + tract + "_PP",
+                         "# subjectname " + os.path.basename(session_dir)]
+                lines += ["{} {:.6f}".format(m, random.random() * 100) for m in PATHSTATS_MEASURES]
+                touch(os.path.join(tract_dir, "pathstats.overall.txt"), "\n".join(lines) + "\n")
+                touch(os.path.join(tract_dir, "pathstats.byvoxel.txt"), "# byvoxel\n")
+
+
+def make_stubs(bin_dir, n_slices):
+    os.makedirs(bin_dir)
+    stubs = {"trac-all": TRAC_ALL_STUB.format(python=sys.executable, tracts=TRACTS, n_slices=n_slices),
+             "bids-validator": SHELL_STUB,
+             "run_freesurfer.py": SHELL_STUB}
+    for name, content in stubs.items():
+        touch(os.path.join(bin_dir, name), content)
+        os.chmod(os.path.join(bin_dir, name), 0o755)
+
+
+def remove_files(pattern):
+    for f in glob(pattern):
+        os.remove(f)
+
+
+class Benchmark(object):
+    """
+    runs phases and collects their timings
+    wall and cpu time (of the python process and of its commands) per phase, peak rss of the python process so
+    far and, with trace_malloc, the peak python heap allocation of the phase
+    """
+
+    def __init__(self, log_file, trace_malloc=False):
+        self.log_file = log_file
+        self.trace_malloc = trace_malloc
+        self.results = []
+
+    def run(self, name, func, *args):
+        gc.collect()
+        if self.trace_malloc:
+            tracemalloc.start()
+        self_before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        # output of the app and of its commands goes to the log file
+        with open(self.log_file, "a") as log, redirect_stdout(log), redirect_stderr(log):
+            value = func(*args)
+        wall = time.perf_counter() - start
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        result = {"phase": name,
+                  "wall_s": wall,
+                  "cpu_s": (self_after.ru_utime + self_after.ru_stime) - (self_before.ru_utime + self_before.ru_stime),
+                  "cmd_cpu_s": (children_after.ru_utime + children_after.ru_stime) -
+                               (children_before.ru_utime + children_before.ru_stime),
+                  # kilobytes on linux
+                  "maxrss_mb": self_after.ru_maxrss / 1024.}
+        if self.trace_malloc:
+            result["py_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024. ** 2
+            tracemalloc.stop()
+        self.results.append(result)
+        print("{phase:<24} {wall_s:10.3f} {cpu_s:10.3f} {cmd_cpu_s:10.3f} {maxrss_mb:10.1f}".format(**result) +
+              (" {:10.1f}".format(result["py_peak_mb"]) if self.trace_malloc else ""))
+        sys.stdout.flush()
+        return value
+
+
+def run_app(*argv):
+    run.main(run.parser.parse_args([str(a) for a in argv]))
+
+
+def simulate_task_graphs(output_dir, subjects, stages):
+    # schedules the task graphs of subjects (with the job files of the participant phase) without running commands
+    for subject in subjects:
+        jobs_dir = os.path.join(output_dir, "sub-" + subject, "jobs")
+        graph = TracTaskGraph(jobs_dir, os.path.join(output_dir, "sub-" + subject, "dmrirc"), stages)
+        done, started = set(), set()
+        ready_tasks = graph.ready_tasks(done, started)
+        while ready_tasks:
+            for task in ready_tasks:
+                started.add(task["id"])
+                done.add(task["id"])
+                graph.task_done(task)
+            ready_tasks = graph.ready_tasks(done, started)
+
+
+def check_data(layout, subjects):
+    return [check_minimal_data_reqs(layout, subject, None) for subject in subjects]
+
+
+def create_dmrirc_files(layout, freesurfer_dir, output_dir, subjects):
+    truly_longitudinal_study = len(layout.get_sessions()) > 1
+    for subject in subjects:
+        _, sessions = check_minimal_data_reqs(layout, subject, None)
+        info = {}
+        for session in (sessions if truly_longitudinal_study else [""]):
+            dwi_files, bvecs_files, bvals_files = get_data(layout, subject, freesurfer_dir, truly_longitudinal_study,
+                                                           session_label=session)
+            name = "sub-" + subject + ("_ses-" + session if session else "")
+            info[name] = {"dwi_files": dwi_files, "bvecs_files": bvecs_files, "bvals_files": bvals_files,
+                          "base": "sub-" + subject if session else ""}
+        os.makedirs(os.path.join(output_dir, "sub-" + subject), exist_ok=True)
+        create_dmrirc(freesurfer_dir, output_dir, subject, info)
+
+
+def main(args):
+    random.seed(0)
+    work_dir = os.path.abspath(args.work_dir)
+    bids_dir = os.path.join(work_dir, "bids")
+    freesurfer_dir = os.path.join(work_dir, "freesurfer")
+    derivatives_dir = os.path.join(work_dir, "derivatives")
+    participant_dir = os.path.join(work_dir, "participant")
+    dmrirc_dir = os.path.join(work_dir, "dmrirc")
+    cache_dir = os.path.join(work_dir, "cache")
+    bin_dir = os.path.join(work_dir, "bin")
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+    subjects = ["{:05d}".format(s + 1) for s in range(args.n_subjects)]
+    sessions = get_session_labels(args.n_sessions)
+    participant_subjects = subjects[:args.n_participant_subjects]
+    common_args = ["--license_key", "xxx", "--cache_dir", cache_dir, "--n_cpus", args.n_cpus]
+
+    print("Generating {} subjects with {} sessions and {} runs in {}".format(args.n_subjects, args.n_sessions,
+                                                                          args.n_runs, work_dir))
+    benchmark = Benchmark(os.path.join(work_dir, "benchmark.log"), trace_malloc=args.trace_malloc)
+    print("{:<24} {:>10} {:>10} {:>10} {:>10}".format("phase", "wall_s", "cpu_s", "cmd_cpu_s", "maxrss_mb") +
+          (" {:>10}".format("py_peak_mb") if args.trace_malloc else ""))
+    benchmark.run("generate", lambda: (make_bids_dataset(bids_dir, subjects, sessions, args.n_runs, args.n_volumes),
+                                       make_freesurfer_dir(freesurfer_dir, subjects, sessions),
+                                       make_output_tree(derivatives_dir, subjects, sessions),
+                                       make_stubs(bin_dir, args.n_slices)))
+    phases = PHASES if "all" in args.phases else args.phases
+
+    if "validator" in phases:
+        benchmark.run("validator_cold", run_bids_validator, bids_dir, cache_dir)
+        benchmark.run("validator_warm", run_bids_validator, bids_dir, cache_dir)
+    # the index is needed by the following phases
+    benchmark.run("index_cold", load_bids_index, bids_dir, cache_dir)
+    layout = benchmark.run("index_warm", load_bids_index, bids_dir, cache_dir)
+    benchmark.run("get_subjects", get_subjects, bids_dir)
+    if "check_data" in phases:
+        benchmark.run("check_data", check_data, layout, subjects)
+    if "create_dmrirc" in phases:
+        benchmark.run("create_dmrirc", create_dmrirc_files, layout, freesurfer_dir, dmrirc_dir, subjects)
+    if "participant" in phases or "task_graph" in phases:
+        # full participant level runs with stub commands; the second run finds all commands completed
+        participant_args = [bids_dir, participant_dir, "participant", "--freesurfer_dir", freesurfer_dir,
+                            "--participant_label"] + participant_subjects + common_args + \
+                           ["--n_parallel_participants", args.n_parallel_participants]
+        benchmark.run("participant_cold", run_app, *participant_args)
+        benchmark.run("participant_resume", run_app, *participant_args)
+    if "task_graph" in phases:
+        benchmark.run("task_graph", simulate_task_graphs, participant_dir, participant_subjects, ["all"])
+    for level in ["group1", "group2"]:
+        if level in phases:
+            remove_files(os.path.join(cache_dir, "group_*_cache.json"))
+            for run_name in ["cold", "warm"]:
+                # output of a previous run would be moved into the new output
+                shutil.rmtree(os.path.join(derivatives_dir, "00_group2_tract_stats"), ignore_errors=True)
+                benchmark.run(level + "_" + run_name, run_app, bids_dir, derivatives_dir, level, *common_args)
+
+    if args.json_report:
+        with open(args.json_report, "w") as fi:
+            json.dump({"config": vars(args), "results": benchmark.results}, fi, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the orchestration overhead of the tracula bids app "
+                                                 "with synthetic data and stub executables.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("work_dir", help="Directory for the synthetic data. Removed and recreated on every run.")
+    parser.add_argument("--n_subjects", default=100, type=int)
+    parser.add_argument("--n_sessions", default=2, type=int, help="Sessions per subject. 0: no session folders.")
+    parser.add_argument("--n_runs", default=1, type=int, help="DWI runs per session.")
+    parser.add_argument("--n_volumes", default=64, type=int, help="DWI volumes per run (entries in the bval files).")
+    parser.add_argument("--n_slices", default=60, type=int, help="bedpostx slice commands per session.")
+    parser.add_argument("--n_participant_subjects", default=10, type=int,
+                        help="Number of subjects that run through the participant level.")
+    parser.add_argument("--n_cpus", default=4, type=int)
+    parser.add_argument("--n_parallel_participants", default=2, type=int)
+    parser.add_argument("--phases", default=["all"], nargs="+", choices=PHASES + ["all"])
+    parser.add_argument("--trace_malloc", action="store_true",
+                        help="Report the peak python heap allocation of each phase (slows down python code).")
+    parser.add_argument("--json_report", help="Write the config and the results to this json file.")
+    main(parser.parse_args())
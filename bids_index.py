@@ -0,0 +1,235 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+from glob import glob
+
+from atomic_files import write_json
+from tracula import run_cmd
+
+# files of the bids dataset that tracula needs: (datatype folder, suffix, extensions)
+INDEXED_FILES = {"T1w": ("anat", "T1w", (".nii", ".nii.gz")),
+                 "dwi": ("dwi", "dwi", (".nii", ".nii.gz")),
+                 "bvec": ("dwi", "dwi", (".bvec",)),
+                 "bval": ("dwi", "dwi", (".bval",))}
+
+
+def split_bids_filename(filename):
+    # returns (suffix, extension) of a bids filename, e.g. sub-01_ses-1_dwi.nii.gz -> ("dwi", ".nii.gz")
+    stem, ext = filename, ""
+    while True:
+        stem, e = os.path.splitext(stem)
+        if not e:
+            break
+        ext = e + ext
+    return stem.split("_")[-1], ext
+
+
+def get_file_kind(filename, datatype=None):
+    # returns the INDEXED_FILES key of a file or None
+    suffix, ext = split_bids_filename(filename)
+    for kind, (kind_datatype, kind_suffix, kind_extensions) in INDEXED_FILES.items():
+        if suffix == kind_suffix and ext in kind_extensions and datatype in (None, kind_datatype):
+            return kind
+    return None
+
+
+def scan_dirs(path, prefix):
+    # returns sorted (name, path) of subdirectories of path that start with prefix
+    with os.scandir(path) as it:
+        return sorted((e.name, e.path) for e in it if e.name.startswith(prefix) and e.is_dir())
+
+
+def get_dataset_fingerprint(bids_dir):
+    """
+    cheap fingerprint of the folder structure of a bids dataset
+    uses the mtimes of the dataset, subject, session and datatype folders. A folder's mtime changes if files are
+    added, removed or renamed, which are the only changes that affect the index.
+    """
+    h = hashlib.sha1()
+
+    def add(path):
+        h.update("{} {}\n".format(os.path.relpath(path, bids_dir), os.stat(path).st_mtime_ns).encode("utf-8"))
+
+    add(bids_dir)
+    for _, subject_dir in scan_dirs(bids_dir, "sub-"):
+        add(subject_dir)
+        session_dirs = scan_dirs(subject_dir, "ses-") or [("", subject_dir)]
+        for session, session_dir in session_dirs:
+            if session:
+                add(session_dir)
+            for datatype in ["anat", "dwi"]:
+                datatype_dir = os.path.join(session_dir, datatype)
+                if os.path.isdir(datatype_dir):
+                    add(datatype_dir)
+    return h.hexdigest()
+
+
+# top level folders of a bids dataset that bids-validator does not validate
+NOT_VALIDATED_DIRS = ["derivatives", "sourcedata", "code"]
+
+
+def get_dataset_content_fingerprint(bids_dir, exclude_dirs=[]):
+    # fingerprint of all files of a bids dataset (path, size and mtime)
+    # NOT_VALIDATED_DIRS and exclude_dirs (e.g., output and cache dirs inside the dataset) are left out, so that
+    # writing results does not change the fingerprint
+    bids_dir = os.path.abspath(bids_dir)
+    exclude_dirs = set(os.path.abspath(d) for d in exclude_dirs) | \
+        set(os.path.join(bids_dir, d) for d in NOT_VALIDATED_DIRS)
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(bids_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) not in exclude_dirs)
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            st = os.stat(path)
+            h.update("{} {} {}\n".format(os.path.relpath(path, bids_dir), st.st_size, st.st_mtime_ns).encode("utf-8"))
+    return h.hexdigest()
+
+
+def get_dataset_id(bids_dir):
+    # short id of the location of a dataset; cache files of datasets at different paths never replace each other
+    return hashlib.sha1(os.path.abspath(bids_dir).encode("utf-8")).hexdigest()[:12]
+
+
+def remove_old_cache_files(pattern, keep_file):
+    for f in glob(pattern):
+        if f != keep_file:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+
+def run_bids_validator(bids_dir, cache_dir, exclude_dirs=[]):
+    """
+    runs bids-validator on bids_dir, unless the dataset has already been validated in its current state
+    the result of a successful validation is stored in cache_dir under the fingerprint of all files of the dataset.
+    If several tasks start at the same time, the first one validates while the others wait for its result.
+    exclude_dirs: folders inside bids_dir that this app writes to (output dir...), see
+    get_dataset_content_fingerprint
+    """
+    fingerprint = get_dataset_content_fingerprint(bids_dir, exclude_dirs + [cache_dir])
+    prefix = os.path.join(cache_dir, "bids_validation_{}_".format(get_dataset_id(bids_dir)))
+    verdict_file = "{}{}.json".format(prefix, fingerprint)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    with open(os.path.join(cache_dir, "bids_validation.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(verdict_file):
+                print("Dataset {} has already been validated. Skipping bids-validator.".format(bids_dir))
+                return
+            # raises if the dataset is not valid
+            run_cmd("bids-validator " + bids_dir)
+            write_json({"bids_dir": os.path.abspath(bids_dir), "valid": True, "time": time.time()}, verdict_file)
+            # only the verdicts of previous versions of this dataset are removed
+            remove_old_cache_files(prefix + "*.json", verdict_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def build_bids_index(bids_dir):
+    # one pass over the dataset; returns per subject and session lists of the files in INDEXED_FILES
+    bids_dir = os.path.abspath(bids_dir)
+    subjects = {}
+    for subject_name, subject_dir in scan_dirs(bids_dir, "sub-"):
+        subject_label = subject_name[len("sub-"):]
+        subjects[subject_label] = {}
+        session_dirs = scan_dirs(subject_dir, "ses-") or [("", subject_dir)]
+        for session_name, session_dir in session_dirs:
+            session_label = session_name[len("ses-"):]
+            table = {kind: [] for kind in INDEXED_FILES.keys()}
+            # subject and session level files (e.g. sub-01_dwi.bvec) and files in the datatype folders
+            search_dirs = [(None, subject_dir)] + ([(None, session_dir)] if session_label else []) + \
+                          [(d, os.path.join(session_dir, d)) for d in ["anat", "dwi"]]
+            for datatype, search_dir in search_dirs:
+                if not os.path.isdir(search_dir):
+                    continue
+                with os.scandir(search_dir) as it:
+                    for e in it:
+                        kind = get_file_kind(e.name, datatype)
+                        if kind and (datatype or kind in ["bvec", "bval"]) and e.is_file():
+                            table[kind].append(e.path)
+            subjects[subject_label][session_label] = {k: sorted(v) for k, v in table.items()}
+
+    # dataset level bvecs and bvals (e.g. dwi.bvec)
+    root = {kind: sorted(glob(os.path.join(bids_dir, "*" + INDEXED_FILES[kind][2][0]))) for kind in ["bvec", "bval"]}
+    return {"bids_dir": bids_dir, "subjects": subjects, "root": root}
+
+
+class BIDSIndex(object):
+    """
+    index of the files of a bids dataset that are needed to run tracula
+    answers the queries of check_minimal_data_reqs and get_data from per subject/session tables
+    """
+
+    def __init__(self, index):
+        self.bids_dir = index["bids_dir"]
+        self.subjects = index["subjects"]
+        self.root = index["root"]
+
+    def _tables(self, subject, session=None):
+        sessions = self.subjects.get(subject, {})
+        if session:
+            return [sessions[session]] if session in sessions else []
+        return list(sessions.values())
+
+    def get_subjects(self):
+        return sorted(self.subjects.keys())
+
+    def get_sessions(self, subject=None, kind=None):
+        # sessions (of subject) that have at least one file of kind
+        subjects = [subject] if subject else self.subjects.keys()
+        sessions = set()
+        for s in subjects:
+            for session, table in self.subjects.get(s, {}).items():
+                if session and ((kind is None) or table[kind]):
+                    sessions.add(session)
+        return sorted(sessions)
+
+    def get_files(self, kind, subject=None, session=None):
+        # files of kind of subject (and session); without subject, the dataset level files (bvec and bval only)
+        if subject is None:
+            return list(self.root.get(kind, []))
+        return sorted(f for table in self._tables(subject, session) for f in table[kind])
+
+
+def load_bids_index(bids_dir, cache_dir):
+    """
+    returns the BIDSIndex of bids_dir
+    the index is stored in cache_dir under the location (see get_dataset_id) and the fingerprint of the dataset, as
+    it contains absolute paths. It is only built if the dataset has changed since the last run; otherwise loading it
+    only costs the fingerprint. If several tasks start at the same time, the first one builds the index while the
+    others wait for it.
+    """
+    fingerprint = get_dataset_fingerprint(bids_dir)
+    dataset_id = get_dataset_id(bids_dir)
+    prefix = os.path.join(cache_dir, "bids_index_{}_".format(dataset_id))
+    index_file = "{}{}.json".format(prefix, fingerprint)
+    if os.path.exists(index_file):
+        with open(index_file) as fi:
+            return BIDSIndex(json.load(fi))
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with open(os.path.join(cache_dir, "bids_index_{}.lock".format(dataset_id)), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(index_file):
+                with open(index_file) as fi:
+                    return BIDSIndex(json.load(fi))
+            print("Indexing bids dataset {}".format(bids_dir))
+            index = build_bids_index(bids_dir)
+            write_json(index, index_file)
+            # remove indices of previous versions of this dataset
+            remove_old_cache_files(prefix + "*.json", index_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return BIDSIndex(index)
+
+
+def get_subjects(bids_dir):
+    # subject labels of a bids dataset (without building an index)
+    return [name[len("sub-"):] for name, _ in scan_dirs(bids_dir, "sub-")]
@@ -0,0 +1,128 @@
+import json
+import os
+import shutil
+from warnings import warn
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+# group results in parquet format: output_dir/00_group_parquet/<table>
+# motion: one row per subject (and session) with the motion measures and TMI (group1)
+# tract_stats: one row per tract and subject (and session) with the overall pathstats (group2), partitioned by tract
+GROUP_STORE_DIR = "00_group_parquet"
+TABLES = {"motion": [], "tract_stats": ["tract"]}
+
+# columns that are stored as strings; all other columns are stored as float64
+KEY_COLUMNS = ["study", "participant_id", "session_id", "tract", "subject_name", "TMI_info"]
+
+
+def get_study_name(bids_dir):
+    # name of the dataset in dataset_description.json, else the name of bids_dir
+    try:
+        with open(os.path.join(bids_dir, "dataset_description.json")) as fi:
+            name = json.load(fi).get("Name")
+    except (IOError, ValueError):
+        name = None
+    return name if name else os.path.basename(os.path.abspath(bids_dir))
+
+
+def get_table_dir(output_dir, table):
+    return os.path.join(output_dir, GROUP_STORE_DIR, table)
+
+
+def get_schema(df):
+    # keys as strings, measures as floats; the same types in every study, so datasets can be combined
+    return pa.schema([(c, pa.string() if c in KEY_COLUMNS else pa.float64()) for c in df.columns])
+
+
+def write_group_table(output_dir, table, df, study):
+    """
+    writes df as parquet dataset to output_dir/00_group_parquet/<table>, replacing the previous version
+    rows are sorted by participant and session, so that filters on them only read the matching row groups.
+    the dataset is written next to the old one and renamed into place, so readers never see a partial dataset.
+    does nothing (with a warning) if pyarrow is not installed.
+    """
+    if pa is None:
+        warn("pyarrow is not installed. Skipping parquet output of %s." % table)
+        return
+    table_dir = get_table_dir(output_dir, table)
+    df = df.copy()
+    df.insert(0, "study", study)
+    if "session_id" not in df.columns:
+        df.insert(2, "session_id", None)
+    for c in set(KEY_COLUMNS).intersection(df.columns):
+        df[c] = [None if pd.isnull(v) else str(v) for v in df[c]]
+    df = df.sort_values([c for c in ["tract", "participant_id", "session_id"] if c in df.columns], kind="mergesort")
+    arrow_table = pa.Table.from_pandas(df, schema=get_schema(df), preserve_index=False)
+
+    tmp_dir = "{}.{}.tmp".format(table_dir, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    ds.write_dataset(arrow_table, tmp_dir, format="parquet", partitioning=TABLES[table] or None,
+                     partitioning_flavor="hive" if TABLES[table] else None, max_rows_per_group=64 * 1024)
+    old_dir = "{}.{}.old".format(table_dir, os.getpid())
+    if os.path.exists(table_dir):
+        os.rename(table_dir, old_dir)
+    os.rename(tmp_dir, table_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print("Parquet dataset written to", table_dir)
+
+
+def open_group_dataset(output_dirs, table="tract_stats"):
+    """
+    pyarrow dataset of a group table of one or several studies (output dirs); nothing is read yet
+    columns that are missing in a study are null in its rows
+    """
+    if pa is None:
+        raise Exception("pyarrow is required to read the parquet group outputs")
+    if isinstance(output_dirs, str):
+        output_dirs = [output_dirs]
+    datasets = []
+    for output_dir in output_dirs:
+        table_dir = get_table_dir(output_dir, table)
+        if not os.path.isdir(table_dir):
+            raise Exception("No parquet dataset %s. Run the group level first." % table_dir)
+        datasets.append(ds.dataset(table_dir, format="parquet", partitioning="hive" if TABLES[table] else None))
+    if len(datasets) == 1:
+        return datasets[0]
+    return ds.dataset(datasets, schema=pa.unify_schemas([d.schema for d in datasets]))
+
+
+def get_filter(dataset, table, tracts=None, subjects=None, sessions=None, studies=None):
+    # filter expression that keeps the rows whose tract, participant_id... are in the given lists (None keeps all)
+    expression = None
+    for column, values in [("tract", tracts), ("participant_id", subjects), ("session_id", sessions),
+                           ("study", studies)]:
+        if values is None:
+            continue
+        if column not in dataset.schema.names:
+            raise Exception("Table %s has no column %s" % (table, column))
+        condition = ds.field(column).isin([str(v) for v in values])
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def load_group_stats(output_dirs, table="tract_stats", columns=None, **filters):
+    """
+    reads the rows of a group table that match the filters as DataFrame
+    output_dirs: output dir or list of output dirs (one per study)
+    table: "tract_stats" (group2) or "motion" (group1)
+    columns: columns to read; None reads all
+    filters: tracts, subjects, sessions, studies: lists of values to keep (see get_filter)
+    only the partitions (tracts) and row groups that can match the filters are read.
+    e.g. load_group_stats(["/out/study1", "/out/study2"], tracts=["lh.cst"], columns=["participant_id", "FA_Avg"])
+    """
+    dataset = open_group_dataset(output_dirs, table)
+    return dataset.to_table(columns=columns, filter=get_filter(dataset, table, **filters)).to_pandas()
+
+
+def iter_group_stats(output_dirs, table="tract_stats", columns=None, **filters):
+    # as load_group_stats, but yields the matching rows in chunks (DataFrames) to keep memory use low
+    dataset = open_group_dataset(output_dirs, table)
+    for batch in dataset.to_batches(columns=columns, filter=get_filter(dataset, table, **filters)):
+        if batch.num_rows:
+            yield batch.to_pandas()
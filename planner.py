@@ -0,0 +1,163 @@
+import os
+from collections import OrderedDict
+from glob import glob
+
+from atomic_files import write_json
+from tracing import read_trace
+from tracula import check_minimal_data_reqs, is_freesurfer_missing, read_dmrirc_variable
+
+# stages whose runtime is predicted; freesurfer is the recon-all run of a subject, the others are trac-all stages
+PLAN_STAGES = ["freesurfer", "prep", "bedp", "path"]
+
+
+def count_volumes(bval_file):
+    # number of volumes of a dwi run: one b-value per volume
+    with open(bval_file) as fi:
+        return len(fi.read().split())
+
+
+def get_run_volumes(dwi_files, bvals_files):
+    # volumes of each dwi run; a single bval file (e.g., at the dataset level) applies to all runs
+    if len(bvals_files) != len(dwi_files):
+        bvals_files = bvals_files[:1] * len(dwi_files)
+    return [count_volumes(f) for f in bvals_files]
+
+
+def get_session_runs(layout, subject_label, session_label=None):
+    # (dwi runs, volumes) of a subject (and session) in the bids index
+    query = {"subject": subject_label}
+    if session_label:
+        query["session"] = session_label
+    dwi_files = layout.get_files("dwi", **query)
+    bvals_files = layout.get_files("bval", **query) or layout.get_files("bval")
+    run_volumes = get_run_volumes(dwi_files, bvals_files) if bvals_files else []
+    return len(dwi_files), sum(run_volumes)
+
+
+class RuntimeModel(object):
+    """
+    runtime of the stages of a subject predicted from the traces of the subjects that have been processed before
+    (output_dir/sub-*/jobs/trace*.jsonl, including the traces of the queue workers). For each processed subject, the
+    cpu time (user + system) of the successful commands of a stage is divided by the number of dwi volumes (trac-all
+    stages) or of freesurfer sessions (freesurfer). The volumes are counted in the bids index (layout) for the
+    sessions of the dmrirc file. The prediction for a new subject is the median of these rates times its volumes
+    (or sessions).
+    """
+
+    def __init__(self, output_dir, layout):
+        self.rates = {stage: [] for stage in PLAN_STAGES}
+        if not os.path.isdir(output_dir):
+            return
+        for name in sorted(os.listdir(output_dir)):
+            trace_files = glob(os.path.join(output_dir, name, "jobs", "trace*.jsonl"))
+            dmrirc_file = os.path.join(output_dir, name, "dmrirc")
+            if not (name.startswith("sub-") and trace_files and os.path.exists(dmrirc_file)):
+                continue
+            subject_label = name[len("sub-"):]
+            # subjlist: sub-<label> or sub-<label>_ses-<session>
+            session_names = set(read_dmrirc_variable(dmrirc_file, "subjlist"))
+            sessions = [n.split("_ses-", 1)[1] if "_ses-" in n else None for n in session_names]
+            n_volumes = sum(get_session_runs(layout, subject_label, s)[1] for s in sessions)
+            n_sessions = max(1, len(session_names))
+            cpu_times = {}
+            for record in read_trace(sorted(trace_files)):
+                if record.get("returncode") == 0 and not record.get("speculative"):
+                    cpu_times[record.get("stage")] = cpu_times.get(record.get("stage"), 0.) + \
+                        record["utime"] + record["stime"]
+            for stage, cpu_time in cpu_times.items():
+                if stage == "freesurfer":
+                    self.rates[stage].append(cpu_time / n_sessions)
+                elif stage in self.rates and n_volumes:
+                    self.rates[stage].append(cpu_time / n_volumes)
+
+    def n_subjects(self, stage):
+        return len(self.rates[stage])
+
+    def predict(self, stage, n):
+        # cpu seconds of a stage for n volumes (or freesurfer sessions); None if the stage has not been measured
+        rates = sorted(self.rates[stage])
+        if not rates:
+            return None
+        return rates[len(rates) // 2] * n
+
+
+def get_subject_plan(args, layout, subject_label, sessions_to_analyze, truly_longitudinal_study, model):
+    # runs, volumes and predicted cpu seconds per stage of a subject
+    valid_subject, valid_sessions = check_minimal_data_reqs(layout, subject_label, sessions_to_analyze)
+    plan = OrderedDict([("subject", subject_label), ("valid", valid_subject)])
+    if not valid_subject:
+        return plan
+
+    long_sessions = valid_sessions if valid_sessions and truly_longitudinal_study else [None]
+    plan["sessions"] = []
+    for session_label in long_sessions:
+        n_runs, n_volumes = get_session_runs(layout, subject_label, session_label)
+        plan["sessions"].append(OrderedDict([("session", session_label),
+                                             ("n_runs", n_runs),
+                                             ("n_volumes", n_volumes)]))
+    plan["n_volumes"] = sum(s["n_volumes"] for s in plan["sessions"])
+    fs_missing = is_freesurfer_missing(args.freesurfer_dir, subject_label, valid_sessions)
+    plan["freesurfer_missing"] = fs_missing
+
+    stages = PLAN_STAGES[1:] if "all" in args.stages else [s for s in PLAN_STAGES if s in args.stages]
+    if fs_missing:
+        stages = ["freesurfer"] + stages
+    plan["predicted_cpu_seconds"] = OrderedDict(
+        (stage, model.predict(stage, len(long_sessions) if stage == "freesurfer" else plan["n_volumes"]))
+        for stage in stages)
+    predictions = list(plan["predicted_cpu_seconds"].values())
+    plan["predicted_total"] = sum(predictions) if None not in predictions else None
+    return plan
+
+
+def get_makespan(durations, n_slots):
+    # end of the last subject if subjects start in the given order as soon as one of n_slots is free
+    ends = [0.] * n_slots
+    for duration in durations:
+        i = ends.index(min(ends))
+        ends[i] += duration
+    return max(ends)
+
+
+def plan_participants(args, layout, subjects_to_analyze, sessions_to_analyze):
+    """
+    returns the plan of the participant level: valid subjects with their sessions, dwi runs and volumes, the
+    predicted cpu seconds per stage (see RuntimeModel) and the order in which they are processed (--schedule).
+    "lpt" starts the subjects with the longest predicted runtime first (longest processing time first), so that
+    no long subject is left running alone at the end. Without predictions, the number of volumes is used.
+    the makespan is a rough estimate: subjects run on --n_parallel_participants slots and each slot gets an equal
+    share of --n_cpus.
+    """
+    truly_longitudinal_study = True if len(layout.get_sessions()) > 1 else False
+    model = RuntimeModel(args.output_dir, layout)
+    subject_plans = [get_subject_plan(args, layout, subject_label, sessions_to_analyze, truly_longitudinal_study,
+                                      model) for subject_label in subjects_to_analyze]
+    valid = [p for p in subject_plans if p["valid"]]
+    if args.schedule == "lpt":
+        valid = sorted(valid, key=lambda p: (p["predicted_total"] or 0., p["n_volumes"]), reverse=True)
+
+    n_slots = max(1, min(args.n_parallel_participants, len(valid)))
+    cpus_per_slot = max(1., float(args.n_cpus) / n_slots)
+    plan = OrderedDict([("schedule", args.schedule),
+                        ("n_cpus", args.n_cpus),
+                        ("n_parallel_participants", args.n_parallel_participants),
+                        ("history_subjects", OrderedDict((s, model.n_subjects(s)) for s in PLAN_STAGES)),
+                        ("subjects", valid),
+                        ("invalid_subjects", [p["subject"] for p in subject_plans if not p["valid"]]),
+                        ("predicted_makespan_seconds", None)])
+    if valid and all(p["predicted_total"] is not None for p in valid):
+        plan["predicted_makespan_seconds"] = get_makespan([p["predicted_total"] / cpus_per_slot for p in valid],
+                                                          n_slots)
+    return plan
+
+
+def write_plan(plan, plan_file):
+    write_json(plan, plan_file, indent=2)
+    print("{:<20} {:>8} {:>6} {:>10} {:>14}".format("subject", "sessions", "runs", "volumes", "predicted_cpu_s"))
+    for p in plan["subjects"]:
+        print("{:<20} {:>8} {:>6} {:>10} {:>14}".format(
+            p["subject"], len(p["sessions"]), sum(s["n_runs"] for s in p["sessions"]), p["n_volumes"],
+            "{:.0f}".format(p["predicted_total"]) if p["predicted_total"] is not None else "unknown"))
+    if plan["predicted_makespan_seconds"] is not None:
+        print("Predicted makespan: {:.1f} h".format(plan["predicted_makespan_seconds"] / 3600.))
+    print("Plan written to", plan_file)
@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from warnings import warn
+
+from atomic_files import write_atomic
+
+# seconds between two writes of the status files; updates in between only change the state in memory
+PROGRESS_INTERVAL = 10
+
+SUBJECT_STATES = ["queued", "running", "done", "failed", "skipped"]
+
+
+class Progress(object):
+    """
+    live state of a participant run: state and current stage of each subject, running and finished commands per
+    stage, throughput and ETA
+    the state is written every PROGRESS_INTERVAL seconds (if it changed) by a background thread to status_file
+    (json) and metrics_file (prometheus text format, e.g. for the textfile collector of the node exporter). The
+    update methods are called from the command threads and only change counters under a lock.
+    """
+
+    def __init__(self, subjects, status_file=None, metrics_file=None, interval=PROGRESS_INTERVAL):
+        self.status_file = status_file
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.start = time.time()
+        self.subjects = OrderedDict((s, {"state": "queued", "stage": None, "commands_running": 0}) for s in subjects)
+        # per stage: running commands, finished commands, failed commands and their summed wall time
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+        self._changed = True
+        self._stop = threading.Event()
+        self._writer = None
+        if status_file or metrics_file:
+            self._writer = threading.Thread(target=self._write_periodically)
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {"running": 0, "done": 0, "failed": 0, "wall": 0.}
+        return self.stages[stage]
+
+    def set_subject_state(self, subject, state):
+        with self._lock:
+            self.subjects.setdefault(subject, {"state": None, "stage": None, "commands_running": 0})["state"] = state
+            self._changed = True
+
+    def command_started(self, subject, stage):
+        with self._lock:
+            self._stage(stage)["running"] += 1
+            if subject in self.subjects:
+                self.subjects[subject]["stage"] = stage
+                self.subjects[subject]["commands_running"] += 1
+            self._changed = True
+
+    def command_finished(self, subject, stage, wall, ok):
+        with self._lock:
+            stage_state = self._stage(stage)
+            stage_state["running"] -= 1
+            stage_state["done" if ok else "failed"] += 1
+            stage_state["wall"] += wall
+            if subject in self.subjects:
+                self.subjects[subject]["commands_running"] -= 1
+            self._changed = True
+
+    def status(self):
+        # snapshot of the state as dict
+        with self._lock:
+            now = time.time()
+            elapsed = now - self.start
+            counts = OrderedDict((s, 0) for s in SUBJECT_STATES)
+            for subject_state in self.subjects.values():
+                counts[subject_state["state"]] = counts.get(subject_state["state"], 0) + 1
+            finished = counts["done"] + counts["failed"] + counts["skipped"]
+            remaining = len(self.subjects) - finished
+            # subjects finish at the rate of the run so far
+            eta = elapsed / finished * remaining if finished else None
+            stages = OrderedDict()
+            for stage, s in self.stages.items():
+                stages[stage] = OrderedDict([("commands_running", s["running"]),
+                                             ("commands_done", s["done"]),
+                                             ("commands_failed", s["failed"]),
+                                             ("commands_per_hour", (s["done"] + s["failed"]) / elapsed * 3600.),
+                                             ("mean_command_seconds",
+                                              s["wall"] / (s["done"] + s["failed"]) if s["done"] + s["failed"]
+                                              else None)])
+            return OrderedDict([("time", now),
+                                ("elapsed_seconds", elapsed),
+                                ("subjects_total", len(self.subjects)),
+                                ("subjects", counts),
+                                ("eta_seconds", eta),
+                                ("stages", stages),
+                                ("running_subjects", OrderedDict((subject, OrderedDict(
+                                    [("stage", s["stage"]), ("commands_running", s["commands_running"])]))
+                                    for subject, s in self.subjects.items() if s["state"] == "running"))])
+
+    def metrics(self, status):
+        # prometheus text format
+        lines = ["# HELP tracula_subjects Subjects of the current run by state.",
+                 "# TYPE tracula_subjects gauge"]
+        lines += ['tracula_subjects{{state="{}"}} {}'.format(s, n) for s, n in status["subjects"].items()]
+        lines += ["# HELP tracula_eta_seconds Expected time until all subjects are finished.",
+                  "# TYPE tracula_eta_seconds gauge",
+                  "tracula_eta_seconds {}".format(status["eta_seconds"] if status["eta_seconds"] is not None
+                                                  else "NaN")]
+        for name, key, help_text, metric_type in [
+                ("tracula_commands_running", "commands_running", "Running commands by stage.", "gauge"),
+                ("tracula_commands_done_total", "commands_done", "Successful commands by stage.", "counter"),
+                ("tracula_commands_failed_total", "commands_failed", "Failed commands by stage.", "counter"),
+                ("tracula_commands_per_hour", "commands_per_hour", "Finished commands per hour by stage.",
+                 "gauge")]:
+            lines += ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, metric_type)]
+            lines += ['{}{{stage="{}"}} {}'.format(name, stage, s[key]) for stage, s in status["stages"].items()]
+        lines += ["# HELP tracula_status_timestamp_seconds Time of this update.",
+                  "# TYPE tracula_status_timestamp_seconds gauge",
+                  "tracula_status_timestamp_seconds {}".format(status["time"])]
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        with self._lock:
+            self._changed = False
+        status = self.status()
+        if self.status_file:
+            write_atomic(self.status_file, json.dumps(status, indent=2))
+        if self.metrics_file:
+            write_atomic(self.metrics_file, self.metrics(status))
+
+    def _write_periodically(self):
+        while not self._stop.wait(self.interval):
+            if self._changed:
+                try:
+                    self.write()
+                except (IOError, OSError) as e:
+                    # progress output must not stop the run
+                    warn("Could not write progress: %s" % e)
+
+    def close(self):
+        # stops the writer and writes the final state
+        self._stop.set()
+        if self._writer:
+            self._writer.join()
+            self.write()
@@ -2,11 +2,12 @@
 import argparse
 import os
 
-from bids import BIDSLayout
+from bids_index import load_bids_index, get_subjects, run_bids_validator
+from planner import plan_participants, write_plan
+from tracula import participant_level, group_level_motion_stats, group_level_tract_pathstats
+from work_queue import plan_queue, run_worker
 
-from tracula import run_cmd, participant_level, group_level_motion_stats, group_level_tract_pathstats
-
-__version__ = open('/version').read()
+__version__ = open('/version').read() if os.path.exists('/version') else 'unknown'
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                  description='BIDS App for  Tracula processing stream. '
@@ -47,38 +48,104 @@ parser.add_argument('--stages', help='Participant-level trac-all stages to run.
                                      '"all" will run "prep", "bedp" and "path". ',
                     choices=["prep", "bedp", "path", "all"], default=["all"], nargs="+")
 parser.add_argument('--n_cpus', help='Number of CPUs/cores available to use.', default=1, type=int)
+parser.add_argument('--mem_gb', help='Memory (in GB) available to use. Commands are only started if the memory '
+                                     'they are expected to need is available. If not specified, the physical '
+                                     'memory of the node is used.', type=float)
+parser.add_argument('--n_parallel_participants', help='Number of participants that are processed at the same time. '
+                                                      'All participants share the --n_cpus cores.',
+                    default=1, type=int)
+parser.add_argument('--retries', help='Number of times a failed command is run again (after waiting 30 s, 60 s, '
+                                      '120 s...). If a participant still fails, its remaining commands are not '
+                                      'started, the other participants continue. Failed participants are listed in '
+                                      'output_dir/participant_report.json and output_dir/participant_rerun.txt, '
+                                      'and the run exits with an error.', default=0, type=int)
+parser.add_argument('--fs_prefetch', help='Number of upcoming participants for which missing FreeSurfer data is '
+                                          'created while the current participants run TRACULA. 0 runs FreeSurfer '
+                                          'right before TRACULA of each participant. Concurrent recon-all runs '
+                                          'share the --n_cpus cores.', default=0, type=int)
+parser.add_argument('--schedule', help='Order in which participants are processed. "input": as given by '
+                                        '--participant_label or as found in bids_dir, "lpt": longest predicted '
+                                        'runtime first (see --plan), which shortens the total runtime if '
+                                        'participants run in parallel.', choices=["input", "lpt"], default="input")
+parser.add_argument('--plan', help='Dry run of the participant level: writes the valid participants with their '
+                                   'sessions, DWI runs and volumes, the runtimes predicted from the traces of the '
+                                   'participants in output_dir and the processing order (--schedule) to '
+                                   'output_dir/participant_plan.json. Nothing is run.', action='store_true',
+                    default=False)
+parser.add_argument('--scratch_dir', help='Fast local directory (e.g., on the SSD of a compute node). If specified, '
+                                          'the DWI data, FreeSurfer data and previous results of a participant are '
+                                          'copied to scratch_dir/sub-<participant_label>, all stages run there and '
+                                          'the results are copied back to output_dir once all stages succeeded. '
+                                          'If a participant fails, its scratch folder is kept and used by the next '
+                                          'run on the same node.')
+parser.add_argument('--queue_dir', help='Shared directory of a work queue that distributes the participant level '
+                                        'over several nodes. "--queue_mode plan" writes the tasks of all '
+                                        'participants to queue_dir; then any number of runs with '
+                                        '"--queue_mode worker" (with the same bids_dir, output_dir and '
+                                        'freesurfer_dir; runs with other paths are refused) process the tasks '
+                                        'until all are done.')
+parser.add_argument('--queue_mode', help='Role of this run if --queue_dir is specified.', choices=["plan", "worker"],
+                    default="worker")
+parser.add_argument('--status_file', help='JSON file with the live state of the participant level (subjects '
+                                          'done/total, stage of the running subjects, running commands, throughput '
+                                          'per stage and ETA), updated every 10 s. If not specified, '
+                                          'output_dir/participant_status.json is used.')
+parser.add_argument('--metrics_file', help='File to which the live state of the participant level is written in '
+                                           'the Prometheus text format, e.g. '
+                                           '<node exporter textfile directory>/tracula.prom.')
+parser.add_argument('--cache_dir', help='The directory where the index and the validation result of the BIDS '
+                                        'dataset are cached. If not specified, output_dir/.tracula_cache is used. '
+                                        'Runs that share the cache directory index and validate the dataset only '
+                                        'once, as long as it does not change.')
 parser.add_argument('--run-freesurfer-tests-only', help='Dev option to enable freesurfer tests on circleci',
                     dest="run_freesurfer_tests_only", action='store_true', default=False)
 parser.add_argument('-v', '--version', action='version',
                     version='Tracula BIDS-App version {}'.format(__version__))
 
 
-
-
-args = parser.parse_args()
-
-####
-if not args.freesurfer_dir:
-    args.freesurfer_dir = args.output_dir
-
-# check output dir exists or create
-if not os.path.exists(args.output_dir):
-    os.makedirs(args.output_dir)
-
-run_cmd("bids-validator " + args.bids_dir)
-
-layout = BIDSLayout(args.bids_dir)
-
-if args.participant_label:
-    subjects_to_analyze = args.participant_label
-else:
-    subjects_to_analyze = layout.get_subjects()
-
-if args.analysis_level == "participant":
-    participant_level(args, layout, subjects_to_analyze, args.session_label)
-
-elif args.analysis_level == "group1":
-    group_level_motion_stats(args, subjects_to_analyze)
-
-elif args.analysis_level == "group2":
-    group_level_tract_pathstats(args, subjects_to_analyze)
+def main(args):
+    ####
+    if not args.freesurfer_dir:
+        args.freesurfer_dir = args.output_dir
+    if not args.cache_dir:
+        args.cache_dir = os.path.join(args.output_dir, ".tracula_cache")
+    if not args.status_file:
+        args.status_file = os.path.join(args.output_dir, "participant_status.json")
+
+    # check output dir exists or create
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    run_bids_validator(args.bids_dir, args.cache_dir, [args.output_dir, args.freesurfer_dir])
+
+    if args.participant_label:
+        subjects_to_analyze = args.participant_label
+    else:
+        subjects_to_analyze = get_subjects(args.bids_dir)
+
+    if args.analysis_level == "participant":
+        layout = load_bids_index(args.bids_dir, args.cache_dir)
+        if args.plan or args.schedule != "input":
+            plan = plan_participants(args, layout, subjects_to_analyze, args.session_label)
+            if args.plan:
+                write_plan(plan, os.path.join(args.output_dir, "participant_plan.json"))
+                return
+            # invalid subjects are still passed on (at the end), so they are reported as skipped
+            subjects_to_analyze = [p["subject"] for p in plan["subjects"]] + plan["invalid_subjects"]
+
+        if args.queue_dir and args.queue_mode == "plan":
+            plan_queue(args, layout, subjects_to_analyze, args.session_label)
+        elif args.queue_dir:
+            run_worker(args, layout)
+        else:
+            participant_level(args, layout, subjects_to_analyze, args.session_label)
+
+    elif args.analysis_level == "group1":
+        group_level_motion_stats(args, subjects_to_analyze)
+
+    elif args.analysis_level == "group2":
+        group_level_tract_pathstats(args, subjects_to_analyze)
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
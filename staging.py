@@ -0,0 +1,180 @@
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+
+# suffix of files that are being copied; they are renamed once the copy has been verified
+TMP_SUFFIX = ".sync.tmp"
+
+# written directly to output_dir while a subject runs on scratch; never copied in either direction
+SCRATCH_EXCLUDE = [os.path.join("jobs", "trace.jsonl")]
+
+
+def file_checksum(filename):
+    h = hashlib.sha1()
+    with open(filename, "rb") as fi:
+        for chunk in iter(lambda: fi.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def is_unchanged(src, dst):
+    # copies keep the mtime, so a file with the same size and mtime has already been copied
+    if os.path.islink(src):
+        return os.path.islink(dst) and os.readlink(src) == os.readlink(dst)
+    if not os.path.isfile(dst) or os.path.islink(dst):
+        return False
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def copy_verified(src, dst):
+    # copies src next to dst and checks the copy; returns the name of the copy, which still has to be renamed to dst
+    dst_dir = os.path.dirname(dst)
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    tmp_file = os.path.join(dst_dir, "." + os.path.basename(dst) + TMP_SUFFIX)
+    if os.path.lexists(tmp_file):
+        os.remove(tmp_file)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), tmp_file)
+        return tmp_file
+    shutil.copy2(src, tmp_file)
+    if file_checksum(src) != file_checksum(tmp_file):
+        os.remove(tmp_file)
+        raise Exception("Checksum of copy does not match: %s -> %s" % (src, dst))
+    return tmp_file
+
+
+def list_tree(top_dir, exclude=[]):
+    # relative paths of the folders and of the files and symlinks below top_dir: (folders, files)
+    folders, files = [], []
+    for root, dirs, filenames in os.walk(top_dir):
+        # symlinks to folders are listed (and copied) as links
+        filenames += [d for d in dirs if os.path.islink(os.path.join(root, d))]
+        dirs[:] = sorted(d for d in dirs if not os.path.islink(os.path.join(root, d)))
+        folders += [os.path.relpath(os.path.join(root, d), top_dir) for d in dirs]
+        for f in sorted(filenames):
+            rel_path = os.path.relpath(os.path.join(root, f), top_dir)
+            if rel_path not in exclude:
+                files.append(rel_path)
+    return folders, files
+
+
+def sync_dirs(dir_pairs, exclude=[], delete=False):
+    """
+    copies the new and changed files of each (src_dir, dst_dir) pair to dst_dir
+    first all files are copied next to their destination and verified with checksums. Only if all copies succeeded,
+    they are renamed into place. Thus, a failed sync does not change any file in dst_dir, and an interrupted one
+    leaves complete files only (old or new ones). Rerunning the sync completes it.
+    delete: remove files in dst_dir that are not in src_dir
+    exclude: paths relative to src_dir and dst_dir that are neither copied nor deleted
+    """
+    copies = []
+    for src_dir, dst_dir in dir_pairs:
+        folders, files = list_tree(src_dir, exclude)
+        # folders are created right away, including empty ones
+        for rel_path in [""] + folders:
+            if not os.path.isdir(os.path.join(dst_dir, rel_path)):
+                os.makedirs(os.path.join(dst_dir, rel_path))
+        for rel_path in files:
+            src, dst = os.path.join(src_dir, rel_path), os.path.join(dst_dir, rel_path)
+            if not is_unchanged(src, dst):
+                copies.append((copy_verified(src, dst), dst))
+
+    for tmp_file, dst in copies:
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        os.replace(tmp_file, dst)
+
+    if delete:
+        for src_dir, dst_dir in dir_pairs:
+            if not os.path.isdir(dst_dir):
+                continue
+            folders, files = list_tree(dst_dir, exclude)
+            for rel_path in files:
+                if not os.path.lexists(os.path.join(src_dir, rel_path)):
+                    os.remove(os.path.join(dst_dir, rel_path))
+            # deepest folders first
+            for rel_path in reversed(folders):
+                if not os.path.isdir(os.path.join(src_dir, rel_path)) and \
+                        not os.listdir(os.path.join(dst_dir, rel_path)):
+                    os.rmdir(os.path.join(dst_dir, rel_path))
+    return len(copies)
+
+
+def get_tracula_dirs(subject_label, subject_session_info):
+    # tracula folders of a subject: sub-<label> (jobs, dmrirc and cross sectional results) and the long session folders
+    tracula_dirs = ["sub-" + subject_label]
+    for subject_session_name, files in subject_session_info.items():
+        if files["base"]:
+            tracula_dirs.append(subject_session_name + ".long." + files["base"])
+    return tracula_dirs
+
+
+def get_scratch_dirs(scratch_dir, subject_label):
+    # folders of a subject on scratch: (freesurfer_dir, output_dir)
+    subject_scratch_dir = os.path.join(scratch_dir, "sub-" + subject_label)
+    return os.path.join(subject_scratch_dir, "freesurfer"), os.path.join(subject_scratch_dir, "output")
+
+
+def stage_subject(scratch_dir, subject_label, subject_session_info, bids_dir, freesurfer_dir, output_dir):
+    """
+    copies the dwi, bvec and bval files, the freesurfer folders and existing tracula results of a subject to
+    scratch_dir/sub-<label>
+    the scratch folder of a subject does not change between runs, so a run that failed on scratch is resumed from
+    the results that are still there.
+    returns (scratch freesurfer_dir, scratch output_dir, subject_session_info with the files on scratch)
+    """
+    scratch_freesurfer_dir, scratch_output_dir = get_scratch_dirs(scratch_dir, subject_label)
+    if os.path.realpath(freesurfer_dir) == os.path.realpath(output_dir):
+        # freesurfer and tracula share the folders (e.g., sub-<label>); stage them once
+        scratch_freesurfer_dir = scratch_output_dir
+    input_dir = os.path.join(scratch_dir, "sub-" + subject_label, "input")
+    bids_dir = os.path.abspath(bids_dir)
+
+    def input_path(f):
+        # dataset level files (e.g. dwi.bvec) and subject files keep their path relative to the dataset
+        rel_path = os.path.relpath(os.path.abspath(f), bids_dir)
+        return os.path.join(input_dir, rel_path if not rel_path.startswith("..") else os.path.basename(f))
+
+    staged_info = OrderedDict()
+    input_files = []
+    freesurfer_subjects = []
+    for subject_session_name, files in subject_session_info.items():
+        staged_info[subject_session_name] = dict(files)
+        for key in ["dwi_files", "bvecs_files", "bvals_files"]:
+            staged_info[subject_session_name][key] = [input_path(f) for f in files[key]]
+            input_files += files[key]
+        freesurfer_subjects.append(subject_session_name)
+        if files["base"]:
+            freesurfer_subjects += [files["base"], subject_session_name + ".long." + files["base"]]
+
+    n_copied = 0
+    for f in sorted(set(input_files)):
+        if not is_unchanged(f, input_path(f)):
+            os.replace(copy_verified(f, input_path(f)), input_path(f))
+            n_copied += 1
+    dir_pairs = [(os.path.join(freesurfer_dir, s), os.path.join(scratch_freesurfer_dir, s))
+                 for s in sorted(set(freesurfer_subjects))]
+    # only tracula folders; output_dir may also contain other freesurfer folders of the subject
+    dir_pairs += [(os.path.join(output_dir, d), os.path.join(scratch_output_dir, d))
+                  for d in get_tracula_dirs(subject_label, subject_session_info)
+                  if os.path.isdir(os.path.join(output_dir, d))]
+    n_copied += sync_dirs(list(OrderedDict.fromkeys(dir_pairs)), exclude=SCRATCH_EXCLUDE)
+    if not os.path.exists(os.path.join(scratch_output_dir, "sub-" + subject_label)):
+        os.makedirs(os.path.join(scratch_output_dir, "sub-" + subject_label))
+    print("Staged {} files of subject {} to {}".format(n_copied, subject_label, scratch_dir))
+    return scratch_freesurfer_dir, scratch_output_dir, staged_info
+
+
+def sync_subject_results(scratch_dir, subject_label, subject_session_info, output_dir):
+    # copies the tracula results of a subject from scratch to output_dir and removes the subject from scratch
+    # the dmrirc file still refers to the files on scratch; it has to be rewritten (see create_dmrirc)
+    _, scratch_output_dir = get_scratch_dirs(scratch_dir, subject_label)
+    dir_pairs = [(os.path.join(scratch_output_dir, d), os.path.join(output_dir, d))
+                 for d in get_tracula_dirs(subject_label, subject_session_info)
+                 if os.path.isdir(os.path.join(scratch_output_dir, d))]
+    n_copied = sync_dirs(dir_pairs, exclude=SCRATCH_EXCLUDE, delete=True)
+    print("Copied {} files of subject {} from {} to {}".format(n_copied, subject_label, scratch_dir, output_dir))
+    shutil.rmtree(os.path.join(scratch_dir, "sub-" + subject_label))
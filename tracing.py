@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import threading
+
+from atomic_files import write_json
+
+
+class Tracer(object):
+    """
+    writes one json line per command to trace_file: wall time, user/system cpu time and peak rss of the command
+    (from its rusage), return code and the fields passed to record (subject, session, stage...)
+    """
+
+    def __init__(self, trace_file, **fields):
+        # fields: added to every record, e.g. subject
+        self.trace_file = trace_file
+        self.fields = fields
+        self._lock = threading.Lock()
+        self._lanes = {}
+
+    def _lane(self):
+        # small number per thread, so that parallel commands are shown in separate rows of the timeline
+        ident = threading.get_ident()
+        if ident not in self._lanes:
+            self._lanes[ident] = len(self._lanes)
+        return self._lanes[ident]
+
+    def record(self, command, start, end, rusage, returncode, **fields):
+        record = dict(self.fields)
+        record.update(fields)
+        record.update({"cmd": command,
+                       "start": start,
+                       "wall": end - start,
+                       "utime": rusage.ru_utime,
+                       "stime": rusage.ru_stime,
+                       # kilobytes on linux
+                       "maxrss_kb": rusage.ru_maxrss,
+                       "returncode": returncode})
+        with self._lock:
+            record["lane"] = self._lane()
+            # the folder is created with the first record
+            trace_dir = os.path.dirname(self.trace_file)
+            if not os.path.exists(trace_dir):
+                os.makedirs(trace_dir)
+            with open(self.trace_file, "a") as fi:
+                fi.write(json.dumps(record) + "\n")
+
+
+def read_trace(trace_files):
+    records = []
+    for trace_file in trace_files:
+        with open(trace_file) as fi:
+            for line in fi:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # incomplete last line of a killed run
+                    pass
+    return records
+
+
+def export_chrome_trace(trace_files, chrome_trace_file):
+    """
+    converts trace files to the chrome trace event format (chrome://tracing, https://ui.perfetto.dev)
+    one process per subject, one thread per lane; commands are complete ("X") events
+    """
+    records = read_trace(trace_files)
+    t0 = min([r["start"] for r in records] or [0])
+    pids = {}
+    events = []
+    for r in records:
+        subject = r.get("subject", "")
+        if subject not in pids:
+            pids[subject] = len(pids) + 1
+            events.append({"name": "process_name", "ph": "M", "pid": pids[subject],
+                           "args": {"name": "sub-{}".format(subject) if subject else "tracula"}})
+        events.append({"name": r.get("task") or r["cmd"].split()[0],
+                       "cat": r.get("stage", ""),
+                       "ph": "X",
+                       "ts": (r["start"] - t0) * 1e6,
+                       "dur": r["wall"] * 1e6,
+                       "pid": pids[subject],
+                       "tid": r.get("lane", 0),
+                       "args": r})
+    write_json({"traceEvents": events, "displayTimeUnit": "ms"}, chrome_trace_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts tracula trace files (sub-<label>/jobs/trace.jsonl) into "
+                                                 "one Chrome trace / Perfetto file.")
+    parser.add_argument("trace_files", nargs="+")
+    parser.add_argument("chrome_trace_file")
+    args = parser.parse_args()
+    export_chrome_trace(args.trace_files, args.chrome_trace_file)
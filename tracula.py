@@ -1,30 +1,334 @@
+import hashlib
+import json
 import os
+import re
+import signal
 import subprocess
-from collections import OrderedDict
-from glob import glob
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from itertools import product
 from subprocess import Popen, PIPE
 from warnings import warn
-from joblib import Parallel, delayed
 
 import pandas as pd
 import shutil
 
-# from https://github.com/BIDS-Apps/freesurfer/blob/master/run.py#L11
-def run_cmd(command, env={}, ignore_errors=False):
-    merged_env = os.environ
-    merged_env.update(env)
+from atomic_files import write_atomic, write_json
+from group_store import get_study_name, write_group_table
+from progress import Progress
+from staging import stage_subject, sync_subject_results
+from tracing import Tracer, export_chrome_trace
+
+# number of threads that read files of the output dir at group level; reading is bound by file system latency
+N_READ_THREADS = 16
+
+# tracts reconstructed by trac-all
+TRACTS = ["fmajor", "fminor"] + [h + "." + t for h, t in
+                                 product(["lh", "rh"], ["cst", "unc", "ilf", "atr", "ccg", "cab", "slfp", "slft"])]
+
+# characters that need a shell to run a command
+SHELL_CHARS = set("|&;<>()$`\\\"'*?[]#~{}\n")
+
+
+def get_cmd_args(command):
+    # commands without shell syntax are started directly, which saves a shell process per command
+    args = command.split()
+    if SHELL_CHARS.intersection(command) or (args and "=" in args[0]):
+        return ["/bin/sh", "-c", command]
+    return args
+
+
+def run_cmd(command, env={}, ignore_errors=False, log_file=None, echo=True, n_tail_lines=20, tracer=None,
+            trace_fields={}, on_exit=None, cancel=None):
+    """
+    runs command and streams its output (stdout and stderr) in chunks
+    env: variables added to a copy of os.environ for this command only
+    log_file: if given, output is written to this file
+    echo: if True, output is also written to the console; if False, the last n_tail_lines are printed if the
+        command fails
+    tracer: tracing.Tracer; if given, wall time, cpu time and peak memory of the command are recorded together
+        with trace_fields (stage, session...)
+    on_exit: if given, called with (start, end, rusage, returncode) once the command has finished
+    cancel: threading.Event; if it is set while the command runs, the command and its children are terminated and
+        run_cmd returns without raising. If it is set before, the command is not started and None is returned.
+    returns the return code
+    """
+    cmd_env = os.environ.copy()
+    cmd_env.update(env)
     # DEBUG env triggers freesurfer to produce gigabytes of files
-    merged_env.pop('DEBUG', None)
-    process = Popen(command, stdout=PIPE, stderr=subprocess.STDOUT, shell=True, env=merged_env)
-    while True:
-        line = process.stdout.readline()
-        line = str(line, 'utf-8')[:-1]
-        print(line)
-        if line == '' and process.poll() != None:
-            break
-    if process.returncode != 0 and not ignore_errors:
-        raise Exception("Non zero return code: %d" % process.returncode)
+    cmd_env.pop('DEBUG', None)
+
+    if cancel is not None and cancel.is_set():
+        return None
+
+    tail = deque(maxlen=16)
+    log = open(log_file, "wb") if log_file else None
+    try:
+        start = time.time()
+        # a cancellable command gets its own process group, so that it can be terminated with all its children
+        process = Popen(get_cmd_args(command), stdout=PIPE, stderr=subprocess.STDOUT, env=cmd_env,
+                        start_new_session=cancel is not None)
+        exited = threading.Event()
+        if cancel is not None:
+            exited_lock = threading.Lock()
+
+            def terminate_on_cancel():
+                while not exited.is_set():
+                    if cancel.wait(0.2):
+                        with exited_lock:
+                            if not exited.is_set():
+                                os.killpg(process.pid, signal.SIGTERM)
+                        return
+
+            watcher = threading.Thread(target=terminate_on_cancel)
+            watcher.daemon = True
+            watcher.start()
+        fd = process.stdout.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            if log:
+                log.write(chunk)
+            if echo:
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+            else:
+                tail.append(chunk)
+        process.stdout.close()
+        if cancel is not None:
+            # the process group must not be signalled once the process has been reaped
+            with exited_lock:
+                exited.set()
+        # wait4 instead of wait to get the resource usage of the command (and its children)
+        _, status, rusage = os.wait4(process.pid, 0)
+        # same convention as Popen: -N if the command was killed by signal N
+        returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        process.returncode = returncode
+    finally:
+        if log:
+            log.close()
+
+    end = time.time()
+    if tracer:
+        tracer.record(command, start, end, rusage, returncode, **trace_fields)
+    if on_exit:
+        on_exit(start, end, rusage, returncode)
+
+    if cancel is not None and cancel.is_set():
+        print("Command cancelled: {}".format(command))
+        return returncode
+    if returncode != 0 and not ignore_errors:
+        if not echo:
+            lines = b"".join(tail).decode("utf-8", "replace").splitlines()[-n_tail_lines:]
+            print("Command failed: {}\n{}".format(command, "\n".join(lines)))
+        raise Exception("Non zero return code: %d (%s)" % (returncode, command))
+    return returncode
+
+
+# declared cost of the command classes (cpus, memory in MB) as long as no measurements are available
+# None: all cpus of the node; recon-all gets --n_cpus, see run_fs_if_not_available
+# job file commands are classified by the job file they come from, "jobs" are the trac-all calls that write them
+DEFAULT_COSTS = {"recon-all": (None, 4096),
+                 "jobs": (1, 512),
+                 "prep": (1, 2048),
+                 "bedp.pre": (1, 1024),
+                 "bedp": (1, 1024),
+                 "bedp.post": (1, 1024),
+                 "path": (1, 4096)}
+
+# number of measurements per command class that are kept to estimate the cost of the next command
+N_PROFILE_SAMPLES = 50
+
+# seconds before the first retry of a failed command; doubled for every further retry
+RETRY_BACKOFF_SECONDS = 30
+
+
+def get_total_memory_mb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024. ** 2
+
+
+class ResourceProfile(object):
+    """
+    measured cpu usage, peak memory and wall time of the command classes, stored in profile_file
+    the last N_PROFILE_SAMPLES successful commands of each class are kept. Estimates are the average number of
+    busy cpus and wall time and the largest peak memory (plus a margin) of these commands.
+    """
+
+    def __init__(self, profile_file):
+        self.profile_file = profile_file
+        self._lock = threading.Lock()
+        self.samples = {}
+        if os.path.exists(profile_file):
+            try:
+                with open(profile_file) as fi:
+                    self.samples = json.load(fi)
+            except ValueError:
+                warn("Could not read resource profile %s. Starting a new one." % profile_file)
+
+    def add(self, cost_class, wall, cpu_time, maxrss_kb, n_cmds=1):
+        # n_cmds: number of commands of the class that ran one after the other (batch); times are per command
+        with self._lock:
+            samples = self.samples.setdefault(cost_class, [])
+            samples.append({"wall": wall / n_cmds, "cpu_time": cpu_time / n_cmds, "mem_mb": maxrss_kb / 1024.})
+            del samples[:-N_PROFILE_SAMPLES]
+
+    def estimate(self, cost_class):
+        # returns (cpus, mem_mb, wall) or None if the class has not been measured yet
+        with self._lock:
+            samples = list(self.samples.get(cost_class, []))
+        if not samples:
+            return None
+        wall = sum(s["wall"] for s in samples) / len(samples)
+        cpus = sum(s["cpu_time"] for s in samples) / max(sum(s["wall"] for s in samples), 1e-6)
+        mem_mb = max(s["mem_mb"] for s in samples) * 1.2
+        return max(1, int(round(cpus))), mem_mb, wall
+
+    def save(self):
+        profile_dir = os.path.dirname(self.profile_file)
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        with self._lock:
+            write_json(self.samples, self.profile_file)
+
+
+class ResourcePool(object):
+    """
+    cpus and memory shared by all commands of all participants that run concurrently
+    a command is admitted once the cpus and memory of its class are free (see DEFAULT_COSTS; with a profile, the
+    measured usage of earlier commands of the class is used instead). Commands are admitted in the order they
+    arrive; the first waiting command reserves its resources, so that a large command (e.g., recon-all) is not
+    starved by small ones. A later command may start before it only if it is expected to finish before any running
+    command does, i.e., before the reserved resources become free.
+    a failed command is run again up to retries times (see run_cmd).
+    progress: progress.Progress that counts the running and finished commands
+    """
+
+    def __init__(self, n_cpus, mem_mb=None, profile=None, costs=DEFAULT_COSTS, retries=0, progress=None):
+        self.n_cpus = n_cpus
+        self.retries = retries
+        self.progress = progress
+        self.mem_mb = mem_mb if mem_mb else get_total_memory_mb()
+        self.profile = profile
+        self.costs = costs
+        self.free_cpus = n_cpus
+        self.free_mem_mb = self.mem_mb
+        self._cond = threading.Condition()
+        self._waiting = []
+        # id of the request: (request, start time)
+        self._running = {}
+
+    def cost(self, cost_class, cpus=None, n_cmds=1):
+        # returns (cpus, mem_mb, expected wall time or None)
+        # cpus: number of cpus the command is started with; replaces the declared cpus of the class and caps the
+        # estimate
+        # n_cmds: number of commands of the class that run one after the other (batch)
+        declared_cpus, mem_mb = self.costs.get(cost_class, (1, 0))
+        if cpus is None:
+            cpus = self.n_cpus if declared_cpus is None else declared_cpus
+        wall = None
+        estimate = self.profile.estimate(cost_class) if self.profile else None
+        if estimate:
+            cpus, mem_mb, wall = min(estimate[0], cpus), estimate[1], estimate[2] * n_cmds
+        # a command that needs more than the node has runs on its own
+        return min(cpus, self.n_cpus), min(mem_mb, self.mem_mb), wall
+
+    def _time_to_next_release(self):
+        # expected time until the first running command finishes; 0 if unknown
+        now = time.time()
+        remaining = [start + request["wall"] - now if request["wall"] is not None else 0.
+                     for request, start in self._running.values()]
+        return max(0., min(remaining)) if remaining else 0.
+
+    def _can_start(self, request):
+        # cpus and memory left after the waiting requests that arrived earlier have started (cpus, mem_mb) or
+        # after they have started or reserved their resources (reserved_cpus, reserved_mem_mb)
+        cpus, mem_mb = self.free_cpus, self.free_mem_mb
+        reserved_cpus, reserved_mem_mb = cpus, mem_mb
+        for r in self._waiting:
+            if r is request:
+                break
+            if r["cpus"] <= cpus and r["mem_mb"] <= mem_mb:
+                cpus -= r["cpus"]
+                mem_mb -= r["mem_mb"]
+            reserved_cpus -= r["cpus"]
+            reserved_mem_mb -= r["mem_mb"]
+        if request["cpus"] <= reserved_cpus and request["mem_mb"] <= reserved_mem_mb:
+            return True
+        # backfill
+        return request["cpus"] <= cpus and request["mem_mb"] <= mem_mb and request["wall"] is not None and \
+            request["wall"] <= self._time_to_next_release()
+
+    @contextmanager
+    def slot(self, cost_class=None, cpus=None, n_cmds=1):
+        cpus, mem_mb, wall = self.cost(cost_class, cpus, n_cmds)
+        request = {"cost_class": cost_class, "cpus": cpus, "mem_mb": mem_mb, "wall": wall}
+        with self._cond:
+            self._waiting.append(request)
+            while not self._can_start(request):
+                self._cond.wait()
+            self._waiting = [r for r in self._waiting if r is not request]
+            self.free_cpus -= cpus
+            self.free_mem_mb -= mem_mb
+            self._running[id(request)] = (request, time.time())
+            # requests behind this one might fit now
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.free_cpus += cpus
+                self.free_mem_mb += mem_mb
+                del self._running[id(request)]
+                self._cond.notify_all()
+
+    def run_cmd(self, command, cost_class=None, cpus=None, n_cmds=1, on_start=None, **kwargs):
+        # measured usage of successful commands feeds the estimates of later commands of the class
+        # on_start: if given, called once the command has been admitted
+        cancel = kwargs.get("cancel")
+
+        def on_exit(start, end, rusage, returncode):
+            if self.profile and cost_class and returncode == 0 and not (cancel and cancel.is_set()):
+                self.profile.add(cost_class, end - start, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss,
+                                 n_cmds)
+
+        # transient failures (e.g., a full disk or an unavailable license server) are retried after a backoff,
+        # during which the resources of the command are free for others
+        for attempt in range(self.retries + 1):
+            try:
+                with self.slot(cost_class, cpus, n_cmds):
+                    if cancel is not None and cancel.is_set():
+                        # cancelled while waiting for resources
+                        return None
+                    if on_start:
+                        on_start()
+                    if not self.progress:
+                        return run_cmd(command, on_exit=on_exit, **kwargs)
+                    # the subject is a field of its tracer
+                    subject = kwargs["tracer"].fields.get("subject") if kwargs.get("tracer") else None
+                    stage = kwargs.get("trace_fields", {}).get("stage", cost_class)
+                    self.progress.command_started(subject, stage)
+                    start, ok = time.time(), False
+                    try:
+                        returncode = run_cmd(command, on_exit=on_exit, **kwargs)
+                        ok = True
+                        return returncode
+                    finally:
+                        self.progress.command_finished(subject, stage, time.time() - start, ok)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+            delay = RETRY_BACKOFF_SECONDS * 2 ** attempt
+            print("Retry {} of {} in {} s: {}".format(attempt + 1, self.retries, delay, command))
+            if cancel is None:
+                time.sleep(delay)
+            elif cancel.wait(delay):
+                return None
 
 
 def get_data(layout, subject_label, freesurfer_dir, truly_longitudinal_study, session_label=""):
@@ -39,16 +343,15 @@ def get_data(layout, subject_label, freesurfer_dir, truly_longitudinal_study, se
     else:
         subject_session_info = {"subject": subject_label}
 
-    dwi_files = [f.filename for f in layout.get(type="dwi", modality="dwi", extensions=["nii", "nii.gz"],
-                                                **subject_session_info)]
-    bvecs_files = layout.get_bvecs(**subject_session_info)
+    dwi_files = layout.get_files("dwi", **subject_session_info)
+    bvecs_files = layout.get_files("bvec", **subject_session_info)
     if not bvecs_files:
         # if bvecs only in root dir
-        bvecs_files = layout.get_bvecs()
-    bvals_files = layout.get_bvals(**subject_session_info)
+        bvecs_files = layout.get_files("bvec")
+    bvals_files = layout.get_files("bval", **subject_session_info)
     if not bvals_files:
         # if bvals only in root dir
-        bvals_files = layout.get_bvals()
+        bvals_files = layout.get_files("bval")
 
     # check if all data is there
     if not dwi_files:
@@ -108,30 +411,231 @@ def create_dmrirc(freesurfer_dir, output_dir, subject_label, subject_session_inf
     return dmrirc_file
 
 
-def run_trac_parallel(stage, jobs_dir, dmrirc_file, n_cpus, job_names=[""], sep="\n"):
+# trac-all job files in processing order: (stage, job file name, command separator)
+# trac-all -bedp writes three job files that have to run one after the other
+TRAC_JOB_FILES = OrderedDict([("prep", [("prep", ";")]),
+                              ("bedp", [("bedp.pre", "\n"), ("bedp", "\n"), ("bedp.post", "\n")]),
+                              ("path", [("path", "\n")])])
+
+# bedp slice commands of a session run in batches of about BEDP_BATCH_SECONDS (based on the measured time per
+# slice), but a session is split into at least n_cpus batches
+BEDP_BATCH_SECONDS = 60
+# a slice batch that runs SPECULATION_FACTOR times longer than the median of the finished batches of its subject is
+# started a second time on an idle cpu; the copy that finishes first is kept
+SPECULATION_FACTOR = 1.5
+# number of finished batches needed before batches are considered stragglers
+SPECULATION_MIN_SAMPLES = 3
+# seconds between two checks for stragglers
+SPECULATION_INTERVAL = 10
+SPECULATIVE_SUFFIX = ".speculative"
+
+
+def get_batch_size(n_cmds, n_cpus, cmd_seconds):
+    # number of commands per batch; without a measured time per command every command runs on its own
+    if not cmd_seconds:
+        return 1
+    return max(1, min(int(BEDP_BATCH_SECONDS / cmd_seconds), n_cmds // max(1, n_cpus)))
+
+
+def read_dmrirc_variable(dmrirc_file, name):
+    # returns the values of a variable of a dmrirc file as list ("set name = (a b)" or "set name = a")
+    with open(dmrirc_file) as fi:
+        for line in fi:
+            line = line.strip()
+            if line.startswith("set ") and line[4:].split("=", 1)[0].strip() == name:
+                value = line.split("=", 1)[1].strip()
+                if value.startswith("("):
+                    value = value[1:].rsplit(")", 1)[0]
+                return value.split()
+    return []
+
+
+def get_dmrirc_sessions(dmrirc_file):
+    # returns the subject/session names (subjlist) of a dmrirc file in order of appearance
+    return list(OrderedDict.fromkeys(read_dmrirc_variable(dmrirc_file, "subjlist")))
+
+
+def get_cmd_sessions(cmd, sessions):
+    # returns the sessions whose directories a job file command refers to
+    # for long data the session name (sub-01_ses-1) is part of the directory name (sub-01_ses-1.long.sub-01);
+    # make sure that sub-01_ses-1 does not match sub-01_ses-10
+    return [s for s in sessions if re.search(re.escape(s) + r"(?![A-Za-z0-9])", cmd)]
+
+
+def get_inputs_fingerprint(dmrirc_file):
+    # hash of the dmrirc content and of path, size and mtime of the dwi, bvecs and bvals files
+    h = hashlib.sha1()
+    with open(dmrirc_file, "rb") as fi:
+        h.update(fi.read())
+    for name in ["dcmlist", "bveclist", "bvallist"]:
+        for f in read_dmrirc_variable(dmrirc_file, name):
+            st = os.stat(f)
+            h.update("{} {} {}\n".format(f, st.st_size, st.st_mtime).encode("utf-8"))
+    return h.hexdigest()
+
+
+def get_cmd_outputs(cmd, output_dir):
+    # files and folders in output_dir that a command refers to (e.g., --logdir=<output_dir>/...)
+    prefixes = tuple(set([os.path.join(output_dir, ""), os.path.join(os.path.abspath(output_dir), "")]))
+    paths = [p for p in re.split(r"[\s=,]+", cmd) if p.startswith(prefixes)]
+    return sorted(set(p for p in paths if os.path.exists(p)))
+
+
+class CompletionManifest(object):
     """
-    use dmrirc file to create jobfiles for traclula bedpost or path and runs jobs in parallel via joblib
-    stage: prep, bedp or path
+    record of the commands of a subject that have finished successfully, stored in jobs/manifest.jsonl
+    one line per finished command with the command, the fingerprint of the inputs and the outputs of the command.
+    on a rerun, a command is complete if it has been run with the same inputs and all its outputs still exist.
+    the file is only appended to, so a killed run loses at most the line that was being written.
     """
 
-    jobs_filename = os.path.join(jobs_dir, stage + ".txt")
-
-    # create job files
-    cmd = "trac-all -{stage} -c {dmrirc_file} -jobs {jobs_filename}".format(stage=stage,
-                                                                            dmrirc_file=dmrirc_file,
-                                                                            jobs_filename=jobs_filename)
-    run_cmd(cmd)
+    def __init__(self, manifest_file, inputs_fingerprint):
+        self.manifest_file = manifest_file
+        self.inputs_fingerprint = inputs_fingerprint
+        self.records = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as fi:
+                for line in fi:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get("inputs") == inputs_fingerprint:
+                        self.records[record["cmd"]] = record
+        if not self.records:
+            # inputs changed or new subject: start a new manifest
+            open(manifest_file, "w").close()
+
+    def is_complete(self, cmd):
+        record = self.records.get(cmd)
+        return bool(record) and all(os.path.exists(p) for p in record["outputs"])
+
+    def add(self, cmd, outputs):
+        record = {"cmd": cmd, "inputs": self.inputs_fingerprint, "outputs": outputs, "time": time.time()}
+        self.records[cmd] = record
+        with open(self.manifest_file, "a") as fi:
+            fi.write(json.dumps(record) + "\n")
+
+
+class TracTaskGraph(object):
+    """
+    task graph of the trac-all commands of one subject
+    trac-all writes the commands of a stage into job files. For each requested stage a task creates the job files,
+    once it is finished its commands are added to the graph. A command of a session only depends on the commands
+    of the same session (and on commands that are not bound to a session, like the prep base command) in the
+    preceding job file. Thus, e.g., bedp of one session can start while prep of another session is still running.
+    a task runs one or several commands (cmds) of a job file; bedp slices of a session are batched, see
+    get_batch_size.
+    """
 
-    # run jobs in parallel
-    for j in job_names:
-        job_file = os.path.join(jobs_dir, stage + j + ".txt")
-        print("Running", job_file)
+    def __init__(self, jobs_dir, dmrirc_file, stages, n_cpus=1, slice_seconds=None):
+        # slice_seconds: measured time of one bedp slice command; if given, slices are run in batches
+        self.jobs_dir = jobs_dir
+        self.n_cpus = n_cpus
+        self.slice_seconds = slice_seconds
+        self.dmrirc_file = dmrirc_file
+        self.output_dir = read_dmrirc_variable(dmrirc_file, "dtroot")[0]
+        self.log_dir = os.path.join(jobs_dir, "logs")
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        self.sessions = get_dmrirc_sessions(dmrirc_file)
+        self.tasks = OrderedDict()
+        # ids of the commands of the last job file that has been added
+        self._previous_job_file = []
+
+        # job files are created in stage order. bedp and path job files need the preprocessed data, hence they are
+        # created once prep is done. path commands do not wait for the entire bedp stage but only for bedp of their
+        # own session.
+        previous_task = []
+        after_stage = None
+        for stage in TRAC_JOB_FILES.keys():
+            if (stage in stages) or ("all" in stages):
+                jobs_filename = os.path.join(jobs_dir, stage + ".txt")
+                cmd = "trac-all -{stage} -c {dmrirc_file} -jobs {jobs_filename}".format(stage=stage,
+                                                                                        dmrirc_file=dmrirc_file,
+                                                                                        jobs_filename=jobs_filename)
+                job_files = [os.path.join(jobs_dir, j + ".txt") for j, _ in TRAC_JOB_FILES[stage]]
+                self._add_task("jobs:" + stage, cmd, stage, deps=previous_task, after_stage=after_stage,
+                               expand=stage, outputs=job_files)
+                previous_task = ["jobs:" + stage]
+                if stage == "prep":
+                    after_stage = "prep"
+
+    def _add_task(self, task_id, cmd, stage, deps=[], sessions=[], after_stage=None, expand=None, outputs=None,
+                  cmds=None):
+        # outputs: files the task creates; if None, they are taken from the command after it has run
+        # cmds: job file commands that cmd runs one after the other; [cmd] if None
+        self.tasks[task_id] = {"id": task_id,
+                               "cmd": cmd,
+                               "cmds": list(cmds) if cmds else [cmd],
+                               "stage": stage,
+                               "deps": list(deps),
+                               "sessions": list(sessions),
+                               "after_stage": after_stage,
+                               "expand": expand,
+                               "outputs": outputs}
+
+    def _stage_done(self, stage, done):
+        return all(t["id"] in done for t in self.tasks.values() if t["stage"] == stage)
+
+    def dependencies(self, task):
+        # all tasks a task waits for
+        deps = list(task["deps"])
+        if task["after_stage"]:
+            deps += [t["id"] for t in self.tasks.values() if t["stage"] == task["after_stage"]]
+        return deps
+
+    def log_file(self, task):
+        # output of each command goes to jobs/logs/<job file>_<n>.log
+        return os.path.join(self.log_dir, task["id"].replace(":", "_") + ".log")
+
+    def task_records(self, task):
+        # (command, outputs) of each command of a task for the CompletionManifest
+        # commands are recorded one by one, so that a resumed run may batch them differently
+        if task["outputs"] is not None:
+            return [(task["cmd"], task["outputs"])]
+        return [(cmd, get_cmd_outputs(cmd, self.output_dir)) for cmd in task["cmds"]]
+
+    def speculative_copy(self, task):
+        # a bedp slice batch can run twice at the same time if each slice writes to its own --logdir
+        # returns the command of the copy, which writes to <logdir>.speculative, and the (logdir, logdir of the
+        # copy) pairs; None if the task cannot be copied
+        if not task["id"].startswith("bedp:"):
+            return None
+        logdirs = [re.search(r"--logdir=(\S+)", cmd) for cmd in task["cmds"]]
+        if not all(logdirs):
+            return None
+        copy_cmd = re.sub(r"--logdir=(\S+)", lambda m: "--logdir=" + m.group(1).rstrip("/") + SPECULATIVE_SUFFIX,
+                          task["cmd"])
+        return copy_cmd, [(m.group(1), m.group(1).rstrip("/") + SPECULATIVE_SUFFIX) for m in logdirs]
+
+    def ready_tasks(self, done, started):
+        # tasks that have not been started and whose dependencies are done
+        ready = []
+        for task in self.tasks.values():
+            if task["id"] in started:
+                continue
+            if task["after_stage"] and not self._stage_done(task["after_stage"], done):
+                continue
+            if all(d in done for d in task["deps"]):
+                ready.append(task)
+        return ready
+
+    def task_done(self, task):
+        # after job files have been created, add their commands to the graph
+        if task["expand"]:
+            for job_name, sep in TRAC_JOB_FILES[task["expand"]]:
+                self._add_job_file(task["stage"], job_name, sep)
+
+    def _add_job_file(self, stage, job_name, sep):
+        job_file = os.path.join(self.jobs_dir, job_name + ".txt")
+        print("Adding", job_file)
         with open(job_file) as fi:
             cmd_list = fi.read().strip().split(sep)
-            cmd_list = [c for c in cmd_list if c]
+            cmd_list = [c.strip() for c in cmd_list if c.strip()]
 
         # create dirs before running bedpost
-        if job_file.endswith("bedp.pre.txt"):
+        if job_name == "bedp.pre":
             for cmd in cmd_list:
                 subject_dir = cmd.split(" ")[1]
                 create_dirs = [os.path.join(subject_dir, "..", "dmri.bedpostX", "logs", "monitor"),
@@ -141,102 +645,380 @@ def run_trac_parallel(stage, jobs_dir, dmrirc_file, n_cpus, job_names=[""], sep=
                         os.makedirs(d)
 
         # fix random seed
-        if job_file.endswith("bedp.txt"):
+        if job_name == "bedp":
             seed_str = " --seed=123"
             cmd_list = [c + seed_str for c in cmd_list]
-            print(cmd_list)
-
-
-        # for prep step: hack parallelization: tracula writes all prep commands (1/session + base) into one jobfile and
-        # executes them sequentially; the session steps can be run in parallel, after they are finished, base needs
-        # to be run
-        # this works because we have one dmrirc file per subject
-        if job_file.endswith("prep.txt"):
-            base_cmd = cmd_list.pop(-1)
-
-        print("Running commands", cmd_list)
-        Parallel(n_jobs=n_cpus)(delayed(run_cmd)(cmd) for cmd in cmd_list)
-
-        if job_file.endswith("prep.txt"):
-            print("Running command", base_cmd)
-            run_cmd(base_cmd)
 
+        # batches of consecutive commands of the same session; other job files run each command on its own
+        batches = []
+        cmd_sessions = [get_cmd_sessions(cmd, self.sessions) for cmd in cmd_list]
+        for cmd, sessions in zip(cmd_list, cmd_sessions):
+            batch_size = 1
+            if job_name == "bedp":
+                batch_size = get_batch_size(cmd_sessions.count(sessions), self.n_cpus, self.slice_seconds)
+            if batches and batches[-1][1] == sessions and len(batches[-1][0]) < batch_size:
+                batches[-1][0].append(cmd)
+            else:
+                batches.append(([cmd], sessions))
 
-def run_tract_all(dmrirc_file, output_dir, subject_label, stages, n_cpus):
+        previous = [self.tasks[i] for i in self._previous_job_file]
+        task_ids, session_ids = [], []
+        for n, (cmds, sessions) in enumerate(batches):
+            if sessions:
+                deps = [t["id"] for t in previous if (not t["sessions"]) or set(t["sessions"]) & set(sessions)]
+            else:
+                # commands that are not bound to a session (e.g., the prep base command of long data) wait for the
+                # entire previous job file and for the session commands of their own job file
+                deps = [t["id"] for t in previous] + session_ids
+            task_id = "{}:{}".format(job_name, n)
+            self._add_task(task_id, " && ".join(cmds), stage, deps=deps, sessions=sessions, cmds=cmds)
+            task_ids.append(task_id)
+            if sessions:
+                session_ids.append(task_id)
+
+        # the last prep command of long data is the base command (trac-all writes it after the session commands).
+        # It may refer to session folders, hence it is not left to get_cmd_sessions: it waits for all other prep
+        # commands and all later commands wait for it
+        if job_name == "prep" and len(task_ids) > 1:
+            base_task = self.tasks[task_ids[-1]]
+            base_task["deps"] = list(OrderedDict.fromkeys(base_task["deps"] + task_ids[:-1]))
+            base_task["sessions"] = []
+        self._previous_job_file = task_ids
+
+
+def get_stragglers(graph, running, start_times, durations, copies):
+    # running bedp slice batches that take SPECULATION_FACTOR times longer than the median batch of their job file;
+    # longest running first
+    now = time.time()
+    stragglers = []
+    for task in running.values():
+        job_name = task["id"].split(":")[0]
+        finished = sorted(durations.get(job_name, []))
+        if task["id"] in copies or task["id"] not in start_times or len(finished) < SPECULATION_MIN_SAMPLES or \
+                not graph.speculative_copy(task):
+            continue
+        elapsed = now - start_times[task["id"]]
+        if elapsed > SPECULATION_FACTOR * finished[len(finished) // 2]:
+            stragglers.append((elapsed, task))
+    return [task for _, task in sorted(stragglers, key=lambda s: -s[0])]
+
+
+def run_task_graph(graph, n_cpus, resource_pool, manifest=None, tracer=None):
+    """
+    work-conserving execution of a task graph: every task is started as soon as its dependencies are done
+    manifest: CompletionManifest; tasks that are complete according to the manifest are skipped, unless one of
+    their dependencies had to be run again
+    tracer: tracing.Tracer that records every command
+    once no task is waiting, bedp slice batches that are stragglers (see get_stragglers) are started a second time
+    on idle cpus. The copy writes to other folders (see TracTaskGraph.speculative_copy); whichever finishes first is
+    kept and the other one is terminated. Both use the same seed, so the result does not depend on which one wins.
+    """
+    done, started, running = set(), set(), {}
+    rerun = set()
+    # admission time of running tasks and durations of finished tasks per job file
+    start_times, durations = {}, {}
+    # cancel events of running tasks; speculative copies: future -> task and task id -> state of the copy
+    cancels, copy_futures, copies = {}, {}, {}
+
+    def submit(task, cmd, log_file, cancel, trace_fields={}):
+        # the class of a command is the job file it comes from (or "jobs")
+        on_start = None
+        if not trace_fields.get("speculative"):
+            def on_start():
+                start_times[task["id"]] = time.time()
+        return executor.submit(resource_pool.run_cmd, cmd, cost_class=task["id"].split(":")[0],
+                               n_cmds=len(task["cmds"]), on_start=on_start, log_file=log_file, echo=False,
+                               tracer=tracer, cancel=cancel,
+                               trace_fields=dict(trace_fields, task=task["id"], stage=task["stage"],
+                                                 sessions=task["sessions"]))
+
+    def remove_dirs(logdirs):
+        for _, copy_logdir in logdirs:
+            shutil.rmtree(copy_logdir, ignore_errors=True)
+
+    executor = ThreadPoolExecutor(max_workers=n_cpus)
+    try:
+        while True:
+            ready_tasks = graph.ready_tasks(done, started)
+            while ready_tasks:
+                for task in ready_tasks:
+                    started.add(task["id"])
+                    if manifest and all(manifest.is_complete(cmd) for cmd in task["cmds"]) and \
+                            not rerun.intersection(graph.dependencies(task)):
+                        print("Skipping completed command", task["cmd"])
+                        done.add(task["id"])
+                        graph.task_done(task)
+                    else:
+                        print("Running command", task["cmd"])
+                        rerun.add(task["id"])
+                        cancels[task["id"]] = threading.Event()
+                        running[submit(task, task["cmd"], graph.log_file(task), cancels[task["id"]])] = task
+                ready_tasks = graph.ready_tasks(done, started)
+            if not running and not copy_futures:
+                break
+
+            # nothing is waiting: use idle cpus for copies of stragglers
+            for task in get_stragglers(graph, running, start_times, durations, copies):
+                if len(running) + len(copy_futures) >= n_cpus or resource_pool.free_cpus < 1:
+                    break
+                copy_cmd, logdirs = graph.speculative_copy(task)
+                print("Running speculative copy of straggling command", task["cmd"])
+                remove_dirs(logdirs)
+                copies[task["id"]] = {"cancel": threading.Event(), "logdirs": logdirs, "won": False}
+                copy_futures[submit(task, copy_cmd, graph.log_file(task) + SPECULATIVE_SUFFIX,
+                                    copies[task["id"]]["cancel"], {"speculative": True})] = task
+
+            can_speculate = any(graph.speculative_copy(t) and t["id"] not in copies for t in running.values())
+            finished, _ = wait(list(running) + list(copy_futures),
+                               timeout=SPECULATION_INTERVAL if can_speculate else None,
+                               return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future in copy_futures:
+                    task = copy_futures.pop(future)
+                    copy = copies[task["id"]]
+                    try:
+                        won = future.result() == 0 and not copy["cancel"].is_set() and task["id"] not in done
+                    except Exception:
+                        won = False
+                    if won:
+                        # the original is terminated; its outputs are replaced once it has exited
+                        print("Speculative copy finished first:", task["cmd"])
+                        copy["won"] = True
+                        cancels[task["id"]].set()
+                    else:
+                        remove_dirs(copy["logdirs"])
+                    continue
+
+                task = running.pop(future)
+                copy = copies.get(task["id"])
+                if copy and copy["won"]:
+                    future.exception()
+                    for logdir, copy_logdir in copy["logdirs"]:
+                        if os.path.exists(logdir):
+                            shutil.rmtree(logdir)
+                        os.rename(copy_logdir, logdir)
+                else:
+                    if copy:
+                        copy["cancel"].set()
+                    future.result()
+                    job_name = task["id"].split(":")[0]
+                    durations.setdefault(job_name, []).append(time.time() - start_times[task["id"]])
+                if manifest:
+                    for cmd, outputs in graph.task_records(task):
+                        manifest.add(cmd, outputs)
+                done.add(task["id"])
+                graph.task_done(task)
+    except Exception:
+        # a failed task fails the subject: commands that have not started are skipped and running ones terminated,
+        # so that the subject can be quarantined without waiting for the rest of the graph
+        for cancel in cancels.values():
+            cancel.set()
+        raise
+    finally:
+        # speculative copies are not needed once the graph has finished or failed
+        for copy in copies.values():
+            copy["cancel"].set()
+        executor.shutdown()
+        for copy in copies.values():
+            if not copy["won"]:
+                remove_dirs(copy["logdirs"])
+
+    not_run = [t for t in graph.tasks.keys() if t not in done]
+    if not_run:
+        raise Exception("Task graph could not be finished. Tasks not run: %s" % " ".join(not_run))
+
+
+def run_tract_all(dmrirc_file, output_dir, subject_label, stages, n_cpus, resource_pool=None, tracer=None):
     # run the processing steps prep, bedp and path
+    # commands that have been completed in a previous run with the same inputs are skipped (see CompletionManifest)
     subject_output_dir = os.path.join(output_dir, "sub-" + subject_label)
     jobs_dir = os.path.join(subject_output_dir, "jobs")
     if not os.path.exists(jobs_dir):
         os.makedirs(jobs_dir)
+    if resource_pool is None:
+        resource_pool = ResourcePool(n_cpus)
 
-    if (("prep" in stages) or ("all" in stages)):
-        stage = "prep"
-        run_trac_parallel(stage, jobs_dir, dmrirc_file, n_cpus, job_names=[""], sep=";")
-
-    if (("bedp" in stages) or ("all" in stages)):
-        stage = "bedp"
-        run_trac_parallel(stage, jobs_dir, dmrirc_file, n_cpus, job_names=[".pre", "", ".post"])
+    manifest = CompletionManifest(os.path.join(jobs_dir, "manifest.jsonl"), get_inputs_fingerprint(dmrirc_file))
+    # slices are batched once their runtime has been measured
+    graph = TracTaskGraph(jobs_dir, dmrirc_file, stages, n_cpus=n_cpus, slice_seconds=resource_pool.cost("bedp")[2])
+    run_task_graph(graph, n_cpus, resource_pool, manifest=manifest, tracer=tracer)
+    if tracer:
+        # timeline of all runs of this subject for chrome://tracing or https://ui.perfetto.dev
+        export_chrome_trace([tracer.trace_file], os.path.join(jobs_dir, "trace.json"))
 
-    if (("path" in stages) or ("all" in stages)):
-        stage = "path"
-        run_trac_parallel(stage, jobs_dir, dmrirc_file, n_cpus, job_names=[""])
 
+def scan_output_dir(output_dir, subjects_to_analyze):
+    """
+    one pass over output_dir; returns {subject_label: {session_label: tracula folder}}
+    for long subjects the sessions are the sub-<sub>_ses-<ses>.long.sub-<sub> folders; for cross subjects the
+    session label is "" and the folder is sub-<sub>
+    """
+    cross_dirs, long_dirs = {}, {}
+    with os.scandir(output_dir) as it:
+        for e in it:
+            if not (e.name.startswith("sub-") and e.is_dir()):
+                continue
+            long_match = re.match(r"^sub-([^_]+)_ses-([^.]+)\.long\.sub-\1$", e.name)
+            if long_match:
+                long_dirs.setdefault(long_match.group(1), {})[long_match.group(2)] = e.path
+            elif "_" not in e.name and "." not in e.name:
+                cross_dirs[e.name[len("sub-"):]] = e.path
+
+    subject_dirs = OrderedDict()
+    for subject_label in subjects_to_analyze:
+        if subject_label in long_dirs:
+            subject_dirs[subject_label] = OrderedDict(sorted(long_dirs[subject_label].items()))
+        elif subject_label in cross_dirs:
+            subject_dirs[subject_label] = OrderedDict([("", cross_dirs[subject_label])])
+        else:
+            warn("No tracula folder for %s in %s. Skipping this subject." % (subject_label, output_dir))
+    return subject_dirs
+
+
+def index_session_dir(session_dir, with_tracts):
+    # files of one tracula folder (subject or long session)
+    session_index = {"dir": session_dir,
+                     "motion": os.path.join(session_dir, "dmri", "dwi_motion.txt"),
+                     "tracts": OrderedDict()}
+    dpath = os.path.join(session_dir, "dpath")
+    if with_tracts and os.path.isdir(dpath):
+        with os.scandir(dpath) as it:
+            tract_dirs = sorted(e.name for e in it if e.name.endswith("_avg33_mni_bbr") and e.is_dir())
+        for tract_dir in tract_dirs:
+            # e.g. lh.cst_AS_avg33_mni_bbr -> lh.cst
+            tract = tract_dir.split("_")[0]
+            if tract in session_index["tracts"]:
+                raise Exception("More than one folder for tract %s found, something is wrong. %s" % (tract, dpath))
+            overall = os.path.join(dpath, tract_dir, "pathstats.overall.txt")
+            byvoxel = os.path.join(dpath, tract_dir, "pathstats.byvoxel.txt")
+            session_index["tracts"][tract] = {"dir_name": tract_dir,
+                                              "overall": overall if os.path.exists(overall) else None,
+                                              "byvoxel": byvoxel if os.path.exists(byvoxel) else None}
+    return session_index
+
+
+def index_output_dir(output_dir, subjects_to_analyze, with_tracts=True):
+    """
+    index of the tracula output of subjects_to_analyze: {subject_label: {session_label: session_index}}
+    session_index: {"dir": tracula folder, "motion": dwi_motion.txt, "tracts": {tract: {"dir_name": ...,
+        "overall": pathstats.overall.txt, "byvoxel": pathstats.byvoxel.txt}}}; missing pathstats files are None
+    output_dir is listed once and the dpath folder of each session once (in parallel); all group-level code
+    queries this index instead of globbing the output dir
+    """
+    subject_dirs = scan_output_dir(output_dir, subjects_to_analyze)
+    session_dirs = [d for sessions in subject_dirs.values() for d in sessions.values()]
+    with ThreadPoolExecutor(max_workers=N_READ_THREADS) as executor:
+        session_indices = dict(zip(session_dirs, executor.map(lambda d: index_session_dir(d, with_tracts),
+                                                              session_dirs)))
+    return OrderedDict((subject_label, OrderedDict((session_label, session_indices[d])
+                                                   for session_label, d in sessions.items()))
+                       for subject_label, sessions in subject_dirs.items())
 
-def get_sessions(output_dir, subject_label):
-    # returns sessions in tracula output dir for subject
-    found_folders = sorted(glob(os.path.join(output_dir, "sub-{sub}*.long.*".format(sub=subject_label))))
-    session_labels = []
-    if found_folders:
-        for f in found_folders:
-            session_labels.append(os.path.basename(f).split(".")[0].split("_")[-1].split("-")[-1])
-        return session_labels
-    else:
-        return None
 
+class ParsedFileCache(object):
+    """
+    parsed content of files, stored in a json file between runs
+    a file is only parsed again if its size or mtime has changed. Saving keeps the entries of files that are not read
+    in this run (e.g., other participants of the same output dir), unless the file no longer exists.
+    """
 
-def load_subject_motion_file(output_dir, subject_label, session_label=""):
-    if session_label:
-        long_str = "_ses-{ses}.long.sub-{sub}".format(ses=session_label, sub=subject_label)
-    else:
-        long_str = ""
-    search_str = os.path.join(output_dir, "sub-" + subject_label + long_str, "dmri", "dwi_motion.txt")
-    found_files = sorted(glob(search_str))
-    assert len(found_files) < 2, "More than one motion file found, something is wrong. %s" % search_str
-    if found_files:
-        subject_motion_file = found_files[0]
-        df_subject = pd.read_csv(subject_motion_file, sep=" ")
-        df_subject.index = [subject_label]
-        if session_label:
-            df_subject["session_id"] = session_label
-            # bring session id to the front
-            c = df_subject.columns.tolist()
-            c.remove("session_id")
-            c = ["session_id"] + c
-            df_subject = df_subject[c]
-        return df_subject
-    else:
-        warn("Missing motion file for %s (%s). Skipping this subject." % (subject_label, search_str))
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.used = {}
+        self._lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as fi:
+                return json.load(fi)
+        except (ValueError, OSError):
+            warn("Could not read cache %s. Starting a new one." % self.cache_file)
+            return {}
+
+    def read(self, path, parse):
+        # returns parse(path), or the cached result if the file has not changed; None if path does not exist
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = [st.st_size, st.st_mtime_ns]
+        entry = self.entries.get(path)
+        if not (entry and entry["key"] == key):
+            entry = {"key": key, "data": parse(path)}
+        with self._lock:
+            self.used[path] = entry
+        return entry["data"]
+
+    def read_all(self, paths, parse):
+        with ThreadPoolExecutor(max_workers=N_READ_THREADS) as executor:
+            return list(executor.map(lambda path: self.read(path, parse), paths))
+
+    def save(self):
+        cache_dir = os.path.dirname(self.cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # merged with the current cache file, which another run might have saved in the meantime
+        entries = {path: entry for path, entry in self._load().items()
+                   if path not in self.used and os.path.exists(path)}
+        entries.update(self.used)
+        write_json(entries, self.cache_file)
+
+
+def to_number(value):
+    for number_type in [int, float]:
+        try:
+            return number_type(value)
+        except ValueError:
+            pass
+    return value
+
+
+def read_motion_file(motion_file):
+    # reads dwi_motion.txt (header line and one line of values); returns {measure: value} or None if missing or
+    # incomplete (e.g., only the header or fewer values than measures)
+    try:
+        with open(motion_file) as fi:
+            lines = fi.read().splitlines()
+    except (IOError, OSError):
+        return None
+    if len(lines) < 2 or len(lines[0].split()) != len(lines[1].split()):
         return None
+    return OrderedDict(zip(lines[0].split(), [to_number(v) for v in lines[1].split()]))
 
 
-def get_subject_pathstats_file(output_dir, subject_label, tract, session_label=""):
-    # returns pathstats filename for one tract for subject (and session, if longitudinal)
-    if session_label:
-        long_str = "_ses-{ses}.long.sub-{sub}".format(ses=session_label, sub=subject_label)
-    else:
-        long_str = ""
-
-    search_str = os.path.join(output_dir, "sub-" + subject_label + long_str, "dpath",
-                              tract + "*_avg33_mni_bbr/pathstats.overall.txt")
-    found_files = sorted(glob(search_str))
-    assert len(found_files) < 2, "More than one pathstats file found, something is wrong. %s" % search_str
-    if found_files:
-        subject_tract_stats_file = found_files[0]
-        return subject_tract_stats_file
-    else:
-        warn("Missing file for %s (%s). Skipping this subject for this tract." % (
-            subject_label, search_str))
-        return None
+def read_pathstats_overall(pathstats_file):
+    """
+    reads a pathstats.overall.txt file written by dmri_pathstats
+    returns (subjectname from the header or None, {measure: value})
+    """
+    subject_name = None
+    measures = OrderedDict()
+    with open(pathstats_file) as fi:
+        for line in fi:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == "#":
+                if len(fields) > 2 and fields[1] == "subjectname":
+                    subject_name = fields[2]
+            elif len(fields) == 2:
+                measures[fields[0]] = to_number(fields[1])
+    return subject_name, measures
+
+
+def pathstats_table(pathstats):
+    """
+    table of the overall stats of one tract, in the layout of tractstats2table --overall
+    pathstats: list of (tracula folder name, output of read_pathstats_overall)
+    returns DataFrame with participant_id and one column per measure
+    """
+    columns = OrderedDict([("participant_id", [subject_name or name for name, (subject_name, _) in pathstats])])
+    for m in OrderedDict.fromkeys(m for _, (_, measures) in pathstats for m in measures.keys()):
+        columns[m] = [measures.get(m, float("nan")) for _, (_, measures) in pathstats]
+    return pd.DataFrame(columns)
 
 
 def calculate_tmi(df):
@@ -260,7 +1042,8 @@ def calculate_tmi(df):
     return df
 
 
-def run_fs_if_not_available(args, subject_label, sessions=[]):
+def is_freesurfer_missing(freesurfer_dir, subject_label, sessions=[]):
+    # True if one of the freesurfer folders that tracula needs for the subject (and sessions) is not complete
     freesurfer_subjects = []
 
     if len(sessions) > 1:
@@ -274,12 +1057,14 @@ def run_fs_if_not_available(args, subject_label, sessions=[]):
         # cross
         freesurfer_subjects.extend(["sub-{sub}".format(sub=subject_label)])
 
-    fs_missing = False
-    for fss in freesurfer_subjects:
-        if not os.path.exists(os.path.join(args.freesurfer_dir, fss, "scripts/recon-all.done")):
-            fs_missing = True
+    return any(not os.path.exists(os.path.join(freesurfer_dir, fss, "scripts/recon-all.done"))
+               for fss in freesurfer_subjects)
+
 
-    if fs_missing:
+def run_fs_if_not_available(args, subject_label, sessions=[], resource_pool=None, tracer=None, n_cpus=None):
+    # n_cpus: cpus for recon-all; default: args.n_cpus
+    n_cpus = n_cpus if n_cpus else args.n_cpus
+    if is_freesurfer_missing(args.freesurfer_dir, subject_label, sessions):
         if args.run_freesurfer_tests_only:
             add_opt = "--steps cross-sectional --stages autorecon1"
         else:
@@ -292,34 +1077,40 @@ def run_fs_if_not_available(args, subject_label, sessions=[]):
                                                    out_dir=args.freesurfer_dir,
                                                    subject_label=subject_label,
                                                    license_key=args.license_key,
-                                                   n_cpus=args.n_cpus,
+                                                   n_cpus=n_cpus,
                                                    add_opt=add_opt)
 
         print("Freesurfer for {} not found. Running recon-all.".format(subject_label))
-        run_cmd(cmd)
+        trace_fields = {"task": "recon-all", "stage": "freesurfer"}
+        if resource_pool:
+            resource_pool.run_cmd(cmd, cost_class="recon-all", cpus=n_cpus, tracer=tracer, trace_fields=trace_fields)
+        else:
+            run_cmd(cmd, tracer=tracer, trace_fields=trace_fields)
 
 
 def check_minimal_data_reqs(layout, subject_label, sessions_to_analyze):
     # check if minimal data requirements for subjects are satisfied (at least 1 t1w and 1 dwi image)
+    # layout: bids_index.BIDSIndex
     # returns:
     #   valid_subject: boolean; if True subject has sufficient data to run traclula
     #   valid_sessions: list; for long data: list of sessions with sufficient data
 
-    n_dwi = len(layout.get(subject=subject_label, modality="dwi", type="dwi"))
-    n_t1w = len(layout.get(subject=subject_label, modality="anat", type="T1w"))
+    n_dwi = len(layout.get_files("dwi", subject=subject_label))
+    n_t1w = len(layout.get_files("T1w", subject=subject_label))
     if (n_dwi > 0) & (n_t1w > 0):
         valid_subject = True
     else:
         valid_subject = False
 
     # get sessions that have at least one dwi and one t1w image
-    dwi_sessions = layout.get_sessions(subject=subject_label, modality="dwi", type="dwi")
-    t1w_sessions = layout.get_sessions(subject=subject_label, modality="anat", type="T1w")
-    sessions = list(set(dwi_sessions) & set(t1w_sessions))
+    dwi_sessions = layout.get_sessions(subject=subject_label, kind="dwi")
+    t1w_sessions = layout.get_sessions(subject=subject_label, kind="T1w")
+    # sort sessions, so that the dmrirc file does not change between runs
+    sessions = sorted(set(dwi_sessions) & set(t1w_sessions))
 
     if sessions_to_analyze:
-        sessions_not_found = list(set(sessions_to_analyze) - set(sessions))
-        sessions = list(set(sessions) & set(sessions_to_analyze))
+        sessions_not_found = sorted(set(sessions_to_analyze) - set(sessions))
+        sessions = sorted(set(sessions) & set(sessions_to_analyze))
         if sessions_not_found:
             print("requested sessions %s not found for subject %s" % (" ".join(sessions_not_found), subject_label))
         if not sessions:
@@ -328,8 +1119,8 @@ def check_minimal_data_reqs(layout, subject_label, sessions_to_analyze):
     valid_sessions = []
     if valid_subject:
         for session in sessions:
-            n_dwi = len(layout.get(subject=subject_label, session=session, modality="dwi", type="dwi"))
-            n_t1w = len(layout.get(subject=subject_label, session=session, modality="anat", type="T1w"))
+            n_dwi = len(layout.get_files("dwi", subject=subject_label, session=session))
+            n_t1w = len(layout.get_files("T1w", subject=subject_label, session=session))
             if (n_dwi > 0) & (n_t1w > 0):
                 valid_sessions.append(session)
 
@@ -341,57 +1132,195 @@ def check_minimal_data_reqs(layout, subject_label, sessions_to_analyze):
     return valid_subject, valid_sessions
 
 
+def get_subject_session_info(args, layout, subject_label, valid_sessions, truly_longitudinal_study):
+    # collects the data of all sessions (long) or of the subject (cross) for create_dmrirc
+    subject_session_info = OrderedDict()
+    if valid_sessions and truly_longitudinal_study:
+        # long
+        for session_label in valid_sessions:
+            dwi_files, bvecs_files, bvals_files = get_data(layout, subject_label,
+                                                           args.freesurfer_dir,
+                                                           truly_longitudinal_study,
+                                                           session_label=session_label)
+
+            subject_session_name = "sub-" + subject_label + "_ses-" + session_label
+            subject_session_info[subject_session_name] = {"dwi_files": dwi_files,
+                                                          "bvecs_files": bvecs_files,
+                                                          "bvals_files": bvals_files,
+                                                          "base": "sub-" + subject_label}
+
+    else:
+        # cross
+        subject_session_name = "sub-" + subject_label
+        dwi_files, bvecs_files, bvals_files = get_data(layout,
+                                                       subject_label,
+                                                       args.freesurfer_dir,
+                                                       truly_longitudinal_study)
+        subject_session_info[subject_session_name] = {"dwi_files": dwi_files,
+                                                      "bvecs_files": bvecs_files,
+                                                      "bvals_files": bvals_files,
+                                                      "base": ""}
+    return subject_session_info
+
+
+def get_subject_tracer(args, subject_label):
+    # every command of a subject is recorded in sub-<label>/jobs/trace.jsonl
+    return Tracer(os.path.join(args.output_dir, "sub-" + subject_label, "jobs", "trace.jsonl"), subject=subject_label)
+
+
+def prefetch_freesurfer(args, layout, subject_label, sessions_to_analyze, resource_pool, tracer, n_cpus=None):
+    # runs freesurfer for a subject that has enough data to run tracula, if freesurfer data is missing
+    valid_subject, valid_sessions = check_minimal_data_reqs(layout, subject_label, sessions_to_analyze)
+    if valid_subject:
+        run_fs_if_not_available(args, subject_label, valid_sessions, resource_pool=resource_pool, tracer=tracer,
+                                n_cpus=n_cpus)
+
+
+def run_participant(args, layout, subject_label, sessions_to_analyze, truly_longitudinal_study, resource_pool,
+                    tracer=None, freesurfer=None):
+    # runs freesurfer (if needed) and tracula for one subject
+    # freesurfer: future of prefetch_freesurfer for this subject; if None, freesurfer is run here
+    # returns False if the subject has been skipped because it has not enough data
+    valid_subject, valid_sessions = check_minimal_data_reqs(layout, subject_label, sessions_to_analyze)
+
+    if valid_subject:
+        if tracer is None:
+            tracer = get_subject_tracer(args, subject_label)
+
+        # check for freesurfer and run if missing
+        if freesurfer:
+            # raises if recon-all failed
+            freesurfer.result()
+        else:
+            run_fs_if_not_available(args, subject_label, valid_sessions, resource_pool=resource_pool, tracer=tracer)
+
+        if not args.run_freesurfer_tests_only:
+            # run full tracula processing
+            subject_session_info = get_subject_session_info(args, layout, subject_label, valid_sessions,
+                                                            truly_longitudinal_study)
+            if subject_session_info:
+                subject_output_dir = os.path.join(args.output_dir, "sub-" + subject_label)
+                if not os.path.exists(subject_output_dir):
+                    os.makedirs(subject_output_dir)
+
+                original_session_info = subject_session_info
+                if args.scratch_dir:
+                    # run all stages on local disk; the dmrirc file points to the copies of the data on scratch
+                    freesurfer_dir, output_dir, subject_session_info = stage_subject(
+                        args.scratch_dir, subject_label, subject_session_info, args.bids_dir, args.freesurfer_dir,
+                        args.output_dir)
+                else:
+                    freesurfer_dir, output_dir = args.freesurfer_dir, args.output_dir
+
+                # create dmrirc file and run trac-all commands
+                dmrirc_file = create_dmrirc(freesurfer_dir, output_dir, subject_label, subject_session_info)
+                run_tract_all(dmrirc_file, output_dir, subject_label, args.stages, args.n_cpus,
+                              resource_pool=resource_pool, tracer=tracer)
+
+                if args.scratch_dir:
+                    # results are only copied back if all stages succeeded; the dmrirc file in output_dir then
+                    # refers to the original data again
+                    sync_subject_results(args.scratch_dir, subject_label, subject_session_info, args.output_dir)
+                    create_dmrirc(args.freesurfer_dir, args.output_dir, subject_label, original_session_info)
+    else:
+        warn("Subject {} has not enough data to run TRACULA".format(subject_label))
+    return valid_subject
+
+
+# end-of-run report of the participant level and list of participants to run again, both in output_dir
+RUN_REPORT_FILE = "participant_report.json"
+RERUN_FILE = "participant_rerun.txt"
+
+
+def write_run_report(output_dir, subjects_to_analyze, done, failed, skipped):
+    """
+    writes the outcome of each subject of a participant run to output_dir/participant_report.json
+    done: subjects that finished; failed: {subject: error}; skipped: subjects without enough data. Subjects that
+    are in none of them have not been run (e.g., the run was interrupted).
+    failed and not run subjects are also written to output_dir/participant_rerun.txt, which can be passed back as
+    --participant_label $(cat participant_rerun.txt)
+    """
+    not_run = [s for s in subjects_to_analyze if s not in done and s not in failed and s not in skipped]
+    report = OrderedDict([("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+                          ("done", done),
+                          ("failed", [OrderedDict([("subject", s), ("error", e)]) for s, e in failed.items()]),
+                          ("skipped", [OrderedDict([("subject", s), ("reason", "not enough data")]) for s in skipped]),
+                          ("not_run", not_run),
+                          ("rerun", list(failed.keys()) + not_run)])
+    write_json(report, os.path.join(output_dir, RUN_REPORT_FILE), indent=2)
+    write_atomic(os.path.join(output_dir, RERUN_FILE), " ".join(report["rerun"]) + "\n")
+    print("{} subjects done, {} failed, {} skipped, {} not run. Report written to {}".format(
+        len(done), len(failed), len(skipped), len(not_run), os.path.join(output_dir, RUN_REPORT_FILE)))
+
+
 def participant_level(args, layout, subjects_to_analyze, sessions_to_analyze):
     # if only one session is available for the entire study, use cross sectional stream
     truly_longitudinal_study = True if len(layout.get_sessions()) > 1 else False
 
-    for subject_label in subjects_to_analyze:
-        subject_session_info = OrderedDict()
-        valid_subject, valid_sessions = check_minimal_data_reqs(layout, subject_label, sessions_to_analyze)
-
-        if valid_subject:
-            # check for freesurfer and run if missing
-            run_fs_if_not_available(args, subject_label, valid_sessions)
-
-            if not args.run_freesurfer_tests_only:
-                # run full tracula processing
-                if valid_sessions and truly_longitudinal_study:
-                    # long
-                    for session_label in valid_sessions:
-                        dwi_files, bvecs_files, bvals_files = get_data(layout, subject_label,
-                                                                       args.freesurfer_dir,
-                                                                       truly_longitudinal_study,
-                                                                       session_label=session_label)
-
-                        subject_session_name = "sub-" + subject_label + "_ses-" + session_label
-                        subject_session_info[subject_session_name] = {"dwi_files": dwi_files,
-                                                                      "bvecs_files": bvecs_files,
-                                                                      "bvals_files": bvals_files,
-                                                                      "base": "sub-" + subject_label}
-
-                else:
-                    # cross
-                    subject_session_name = "sub-" + subject_label
-                    dwi_files, bvecs_files, bvals_files = get_data(layout,
-                                                                   subject_label,
-                                                                   args.freesurfer_dir,
-                                                                   truly_longitudinal_study)
-                    subject_session_info[subject_session_name] = {"dwi_files": dwi_files,
-                                                                  "bvecs_files": bvecs_files,
-                                                                  "bvals_files": bvals_files,
-                                                                  "base": ""}
-
-                if subject_session_info:
-                    subject_output_dir = os.path.join(args.output_dir, "sub-" + subject_label)
-                    if not os.path.exists(subject_output_dir):
-                        os.makedirs(subject_output_dir)
-
-                    # create dmrirc file and run trac-all commands
-                    dmrirc_file = create_dmrirc(args.freesurfer_dir, args.output_dir, subject_label,
-                                                subject_session_info)
-                    run_tract_all(dmrirc_file, args.output_dir, subject_label, args.stages, args.n_cpus)
-        else:
-            warn("Subject {} has not enough data to run TRACULA".format(subject_label))
+    # up to n_parallel_participants subjects are processed at the same time; all their commands share the n_cpus
+    # cpus and mem_gb of memory. Measured usage of the commands is kept in the cache dir for the next runs.
+    profile = ResourceProfile(os.path.join(args.cache_dir, "resource_profile.json"))
+    progress = Progress(subjects_to_analyze, status_file=args.status_file, metrics_file=args.metrics_file)
+    resource_pool = ResourcePool(args.n_cpus, args.mem_gb * 1024 if args.mem_gb else None, profile=profile,
+                                 retries=args.retries, progress=progress)
+    print("Running commands on {} cpus and {:.1f} GB of memory".format(resource_pool.n_cpus,
+                                                                      resource_pool.mem_mb / 1024.))
+    n_parallel = max(1, min(args.n_parallel_participants, len(subjects_to_analyze)))
+    tracers = [get_subject_tracer(args, subject_label) for subject_label in subjects_to_analyze]
+
+    # with fs_prefetch, missing freesurfer data of the next fs_prefetch subjects is created while the current
+    # subjects run tracula. recon-all runs then share the cpus: each gets n_cpus / (fs_prefetch + 1)
+    fs_prefetch = args.fs_prefetch
+    fs_n_cpus = max(1, args.n_cpus // (fs_prefetch + 1))
+    fs_futures = {}
+    fs_lock = threading.Lock()
+
+    def get_freesurfer_future(i):
+        # submits freesurfer of subjects i to i + fs_prefetch (if not submitted yet); returns the future of subject i
+        with fs_lock:
+            for j in range(i, min(i + fs_prefetch + 1, len(subjects_to_analyze))):
+                if j not in fs_futures:
+                    fs_futures[j] = fs_executor.submit(prefetch_freesurfer, args, layout, subjects_to_analyze[j],
+                                                       sessions_to_analyze, resource_pool, tracers[j], fs_n_cpus)
+            return fs_futures[i]
+
+    def process_subject(i):
+        freesurfer = get_freesurfer_future(i) if fs_prefetch else None
+        progress.set_subject_state(subjects_to_analyze[i], "running")
+        return run_participant(args, layout, subjects_to_analyze[i], sessions_to_analyze, truly_longitudinal_study,
+                               resource_pool, tracer=tracers[i], freesurfer=freesurfer)
+
+    # a failing subject is quarantined: its remaining commands are not started, while the other subjects continue
+    done, failed, skipped = [], OrderedDict(), []
+    fs_executor = ThreadPoolExecutor(max_workers=fs_prefetch + n_parallel) if fs_prefetch else None
+    try:
+        with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+            futures = OrderedDict((executor.submit(process_subject, i), subject_label)
+                                  for i, subject_label in enumerate(subjects_to_analyze))
+            for future in as_completed(futures):
+                subject_label = futures[future]
+                try:
+                    if future.result():
+                        done.append(subject_label)
+                        progress.set_subject_state(subject_label, "done")
+                    else:
+                        skipped.append(subject_label)
+                        progress.set_subject_state(subject_label, "skipped")
+                except Exception as e:
+                    print("Subject {} failed: {}. Continuing with the other subjects.".format(subject_label, e))
+                    failed[subject_label] = str(e)
+                    progress.set_subject_state(subject_label, "failed")
+    finally:
+        if fs_executor:
+            fs_executor.shutdown()
+        profile.save()
+        progress.close()
+        write_run_report(args.output_dir, subjects_to_analyze, done, failed, skipped)
+
+    if failed:
+        raise Exception("{} of {} subjects failed: {}. See {}".format(len(failed), len(subjects_to_analyze),
+                                                                      " ".join(failed.keys()),
+                                                                      os.path.join(args.output_dir, RUN_REPORT_FILE)))
 
 
 def group_level_motion_stats(args, subjects_to_analyze):
@@ -400,20 +1329,52 @@ def group_level_motion_stats(args, subjects_to_analyze):
     if not os.path.exists(motion_output_dir):
         os.makedirs(motion_output_dir)
     motion_output_file = os.path.join(motion_output_dir, "group_motion.tsv")
-    df = pd.DataFrame([])
-    for subject_label in subjects_to_analyze:
-        sessions = get_sessions(args.output_dir, subject_label)
 
-        if sessions:
-            for session_label in sessions:
-                df_subject = load_subject_motion_file(args.output_dir, subject_label, session_label)
-                df = df.append(df_subject)
-        else:
-            df_subject = load_subject_motion_file(args.output_dir, subject_label, session_label="")
-            df = df.append(df_subject)
+    output_index = index_output_dir(args.output_dir, subjects_to_analyze, with_tracts=False)
+    motion_files = [(subject_label, session_label, session_index["motion"])
+                    for subject_label, sessions in output_index.items()
+                    for session_label, session_index in sessions.items()]
+    # only new or changed motion files are parsed
+    motion_cache = ParsedFileCache(os.path.join(args.cache_dir, "group_motion_cache.json"))
+    motion = motion_cache.read_all([f for _, _, f in motion_files], read_motion_file)
+    motion_cache.save()
+
+    # build the table column-wise
+    participant_ids, session_ids, rows = [], [], []
+    for (subject_label, session_label, motion_file), measures in zip(motion_files, motion):
+        if measures is None:
+            warn("Missing or incomplete motion file for %s (%s). Skipping this subject." % (subject_label,
+                                                                                            motion_file))
+            continue
+        participant_ids.append(subject_label)
+        session_ids.append(session_label if session_label else None)
+        rows.append(measures)
+    if not rows:
+        raise Exception("No motion files found in %s" % args.output_dir)
+
+    columns = OrderedDict()
+    if any(session_ids):
+        columns["session_id"] = session_ids
+    for m in OrderedDict.fromkeys(m for measures in rows for m in measures.keys()):
+        columns[m] = [measures.get(m, float("nan")) for measures in rows]
+    df = pd.DataFrame(columns, index=participant_ids)
+
     df = calculate_tmi(df)
     df.index.name = "participant_id"
     df.to_csv(motion_output_file, sep="\t")
+    write_group_table(args.output_dir, "motion", df.reset_index(), get_study_name(args.bids_dir))
+
+
+def read_group_motion(output_dir):
+    # motion measures and TMI per participant_id and session_id from the group1 output; None if group1 has not run
+    motion_output_file = os.path.join(output_dir, "00_group1_motion_stats", "group_motion.tsv")
+    if not os.path.exists(motion_output_file):
+        return None
+    df = pd.read_csv(motion_output_file, sep="\t", dtype={"participant_id": str, "session_id": str})
+    if "session_id" not in df.columns:
+        df.insert(1, "session_id", None)
+    df["session_id"] = [None if pd.isnull(s) else s for s in df["session_id"]]
+    return df
 
 
 def group_level_tract_pathstats(args, subjects_to_analyze):
@@ -423,59 +1384,107 @@ def group_level_tract_pathstats(args, subjects_to_analyze):
     tract_file_list_dir = os.path.join(overall_stats_output_dir, "00_file_lists")
     if not os.path.exists(tract_file_list_dir):
         os.makedirs(tract_file_list_dir)
-    hemis = ["lh", "rh"]
-    tracts = ["fmajor", "fminor"] + [h + "." + t for h, t in
-                                     (product(hemis, ["cst", "unc", "ilf", "atr", "ccg", "cab", "slfp", "slft"]))]
-    for tract in tracts:
-        tract_file_list = []
-        tract_file_list_output_file = os.path.join(tract_file_list_dir, tract + "_list.txt")
-
-        for subject_label in subjects_to_analyze:
-            sessions = get_sessions(args.output_dir, subject_label)
-
-            if sessions:
-                # long
-                for session_label in sessions:
-                    subject_tract_stats_file = get_subject_pathstats_file(args.output_dir, subject_label, tract,
-                                                                          session_label=session_label)
-                    if subject_tract_stats_file:
-                        tract_file_list.append(subject_tract_stats_file)
-
-            else:
-                # cross
-                subject_tract_stats_file = get_subject_pathstats_file(args.output_dir, subject_label, tract,
-                                                                      session_label="")
-                if subject_tract_stats_file:
-                    tract_file_list.append(subject_tract_stats_file)
-
-        with open(tract_file_list_output_file, "w") as fi:
-            fi.write("\n".join(tract_file_list))
-
-        tract_stats_file = os.path.join(overall_stats_output_dir, tract + "_stats.tsv")
-        cmd = "tractstats2table --load-pathstats-from-file {} --overall --tablefile {}".format(
-            tract_file_list_output_file, tract_stats_file)
-        run_cmd(cmd)
-
-        # reformat tract stats file
-        df = pd.read_csv(tract_stats_file, sep="\t")
+    output_index = index_output_dir(args.output_dir, subjects_to_analyze)
+
+    # collect the pathstats files of all tracts
+    tract_files = OrderedDict()
+    for tract in TRACTS:
+        tract_files[tract] = []
+        for subject_label, sessions in output_index.items():
+            for session_label, session_index in sessions.items():
+                tract_index = session_index["tracts"].get(tract)
+                if tract_index and tract_index["overall"]:
+                    tract_files[tract].append((os.path.basename(session_index["dir"]), tract_index["overall"]))
+                else:
+                    warn("Missing file for %s %s (%s). Skipping this subject for this tract." % (
+                        subject_label, session_label, tract))
+
+        with open(os.path.join(tract_file_list_dir, tract + "_list.txt"), "w") as fi:
+            fi.write("\n".join(f for _, f in tract_files[tract]))
+
+    # read all files in one pass
+    all_files = [f for files in tract_files.values() for _, f in files]
+    # only new or changed pathstats files are parsed
+    pathstats_cache = ParsedFileCache(os.path.join(args.cache_dir, "group_pathstats_cache.json"))
+    pathstats = dict(zip(all_files, pathstats_cache.read_all(all_files, read_pathstats_overall)))
+    pathstats_cache.save()
+
+    tract_dfs = []
+    for tract, files in tract_files.items():
+        df = pathstats_table([(name, pathstats[f]) for name, f in files])
         df["tract"] = tract
-        df.rename(columns={tract: "participant_id"}, inplace=True)
-        df.to_csv(tract_stats_file, sep="\t", index=False)
+        df.to_csv(os.path.join(overall_stats_output_dir, tract + "_stats.tsv"), sep="\t", index=False)
+        tract_dfs.append(df)
+    df_all = pd.concat(tract_dfs, ignore_index=True, sort=False)
+    df_all.to_csv(os.path.join(overall_stats_output_dir, "all_tracts_stats.tsv"), sep="\t", index=False)
+
+    # parquet rows carry the subject and session labels (as in the motion table) instead of the folder name
+    session_labels = {os.path.basename(session_index["dir"]): (subject_label, session_label or None)
+                      for subject_label, sessions in output_index.items()
+                      for session_label, session_index in sessions.items()}
+    labels = [session_labels[name] for files in tract_files.values() for name, _ in files]
+    df_store = df_all.rename(columns={"participant_id": "subject_name"})
+    df_store.insert(0, "participant_id", [subject_label for subject_label, _ in labels])
+    df_store.insert(1, "session_id", [session_label for _, session_label in labels])
+    # one table for analyses of tract stats and motion: the motion measures and TMI of group1 are joined onto the rows
+    motion = read_group_motion(args.output_dir)
+    if motion is None:
+        warn("No group1 output in %s. Run group1 before group2 to add the motion and TMI columns to the parquet "
+             "tract stats." % args.output_dir)
+    else:
+        df_store = df_store.merge(motion, how="left", on=["participant_id", "session_id"], suffixes=("", "_motion"))
+    write_group_table(args.output_dir, "tract_stats", df_store, get_study_name(args.bids_dir))
 
     # create byvoxel stats
-    dmrirc_file = os.path.join(overall_stats_output_dir, "dmrirc_groupstats")
-    subjects = " ".join(df["participant_id"].tolist())
-    dmrirc_str = """
-    set dtroot = {}
-    set subjlist = ( {} )
-    """.format(args.output_dir, subjects)
-    with open(dmrirc_file, "w") as fi:
-        fi.write(dmrirc_str)
+    # one trac-all -stat job per tract, each with its own dtroot, see run_byvoxel_stats
+    run_byvoxel_stats(args, output_index, tract_files, os.path.join(group_output_dir, "byvoxel_stats"))
 
-    cmd = "trac-all -stat -c {}".format(dmrirc_file)
-    run_cmd(cmd)
 
-    # creates a folder in outdir; move folder
-    stats_source_folder = os.path.join(args.output_dir, "stats")
-    stats_dest_folder = os.path.join(group_output_dir, "byvoxel_stats")
-    shutil.move(stats_source_folder, stats_dest_folder)
+def run_byvoxel_stats(args, output_index, tract_files, stats_dir):
+    """
+    runs trac-all -stat for each tract in parallel (--n_cpus jobs) and merges the results into stats_dir
+    trac-all -stat writes to <dtroot>/stats. Each job gets a dtroot in a work folder that links to the tracula
+    folders of the subjects and a dmrirc with the tract in pathlist, so jobs (and concurrent group runs) do not
+    share any output. Logs are written to stats_dir/00_logs.
+    tract_files: {tract: [(tracula folder name, pathstats.overall.txt)]}
+    """
+    log_dir = os.path.join(stats_dir, "00_logs")
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    work_dir = tempfile.mkdtemp(prefix="00_work_", dir=os.path.dirname(stats_dir))
+
+    # e.g. lh.cst -> lh.cst_AS (the tract folder is lh.cst_AS_avg33_mni_bbr)
+    session_dirs = {os.path.basename(i["dir"]): i for sessions in output_index.values() for i in sessions.values()}
+    jobs = []
+    for tract, files in tract_files.items():
+        if not files:
+            continue
+        path_names = OrderedDict.fromkeys(session_dirs[name]["tracts"][tract]["dir_name"][:-len("_avg33_mni_bbr")]
+                                          for name, _ in files)
+        dtroot = os.path.join(work_dir, tract)
+        os.makedirs(dtroot)
+        for name, _ in files:
+            os.symlink(os.path.abspath(session_dirs[name]["dir"]), os.path.join(dtroot, name))
+        dmrirc_file = os.path.join(work_dir, tract + ".dmrirc")
+        with open(dmrirc_file, "w") as fi:
+            fi.write("set dtroot = {}\nset subjlist = ( {} )\nset pathlist = ( {} )\n".format(
+                dtroot, " ".join(name for name, _ in files), " ".join(path_names)))
+        jobs.append((tract, dtroot, "trac-all -stat -c {}".format(dmrirc_file)))
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.n_cpus) as executor:
+            futures = [executor.submit(run_cmd, cmd, log_file=os.path.join(log_dir, tract + ".log"), echo=False)
+                       for tract, _, cmd in jobs]
+            for future in futures:
+                future.result()
+
+        # the results of a tract replace those of earlier runs
+        for _, dtroot, _ in jobs:
+            tract_stats_dir = os.path.join(dtroot, "stats")
+            for f in sorted(os.listdir(tract_stats_dir)) if os.path.isdir(tract_stats_dir) else []:
+                dest = os.path.join(stats_dir, f)
+                if os.path.isdir(dest) and not os.path.islink(dest):
+                    shutil.rmtree(dest)
+                os.replace(os.path.join(tract_stats_dir, f), dest)
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,388 @@
+import json
+import os
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from glob import glob
+from warnings import warn
+
+from atomic_files import write_json
+from tracing import Tracer, export_chrome_trace
+from tracula import TRAC_JOB_FILES, TracTaskGraph, ResourcePool, ResourceProfile, check_minimal_data_reqs, \
+    create_dmrirc, get_subject_session_info, run_fs_if_not_available
+
+# workers touch the claims of their running tasks every HEARTBEAT_INTERVAL seconds; a claim that has not been
+# touched for STALE_CLAIM_TIMEOUT seconds belongs to a dead worker and can be taken over by another worker
+HEARTBEAT_INTERVAL = 30
+STALE_CLAIM_TIMEOUT = 300
+# seconds between two looks at the queue of a worker that has nothing to do
+POLL_INTERVAL = 5
+
+
+def get_task_name(task_id):
+    # file name of a task, e.g. bedp.pre:3 -> bedp.pre_3
+    return task_id.replace(":", "_")
+
+
+class SubjectQueue(object):
+    """
+    tasks of one subject in queue_dir/subjects/sub-<label>
+    tasks/<task>: a task of the TracTaskGraph of the subject, or the prepare task that runs freesurfer and creates
+        the dmrirc file. Task files are written once and never change.
+    claims/<task>: created exclusively (O_EXCL) by the worker that runs the task; its mtime is the heartbeat
+    done/<task>, failed/<task>: outcome of the task
+    finished: all tasks are done
+    """
+
+    def __init__(self, queue_dir, subject_label):
+        self.subject_label = subject_label
+        self.dir = os.path.join(queue_dir, "subjects", "sub-" + subject_label)
+        self._tasks = OrderedDict()
+
+    def path(self, kind, task_name=""):
+        return os.path.join(self.dir, kind, task_name)
+
+    def is_finished(self):
+        return os.path.exists(os.path.join(self.dir, "finished"))
+
+    def add_tasks(self, tasks):
+        # tasks that are already in the queue are not written again, hence adding tasks can be repeated
+        for kind in ["tasks", "claims", "done", "failed"]:
+            if not os.path.exists(self.path(kind)):
+                os.makedirs(self.path(kind))
+        for task in tasks:
+            task_file = self.path("tasks", task["name"])
+            if not os.path.exists(task_file):
+                write_json(task, task_file)
+
+    def tasks(self):
+        for task_name in sorted(os.listdir(self.path("tasks"))):
+            if task_name not in self._tasks and not task_name.endswith(".tmp"):
+                with open(self.path("tasks", task_name)) as fi:
+                    self._tasks[task_name] = json.load(fi)
+        return self._tasks
+
+    def status(self):
+        """
+        returns (ready, live_claims, n_failed, finished)
+        ready: [(task, stale)] tasks whose dependencies are done and that are not claimed or whose claim is stale
+        live_claims: names of the tasks that are running on a worker
+        """
+        # done is listed before the tasks: an expanded task adds its tasks before it is marked done, so the tasks of
+        # every stage that is done here are listed below and after_stage cannot pass before they are known
+        done = set(os.listdir(self.path("done")))
+        failed = set(os.listdir(self.path("failed")))
+        tasks = self.tasks()
+        claims = {}
+        for claim in os.listdir(self.path("claims")):
+            try:
+                claims[claim] = os.stat(self.path("claims", claim)).st_mtime
+            except OSError:
+                # released in the meantime
+                pass
+        now = time.time()
+        ready, live_claims = [], []
+        for task_name, task in tasks.items():
+            if task_name in done or task_name in failed:
+                continue
+            stale = False
+            if task_name in claims:
+                if now - claims[task_name] < STALE_CLAIM_TIMEOUT:
+                    live_claims.append(task_name)
+                    continue
+                stale = True
+            deps = [get_task_name(d) for d in task["deps"]]
+            if task["after_stage"]:
+                deps += [n for n, t in tasks.items() if t["stage"] == task["after_stage"]]
+            if all(d in done for d in deps):
+                ready.append((task, stale))
+        finished = bool(tasks) and all(n in done for n in tasks.keys())
+        return ready, live_claims, len(failed), finished
+
+    def claim(self, task, worker_id, stale=False):
+        # returns True if the task has been claimed by this worker
+        claim_file = self.path("claims", task["name"])
+        if stale:
+            # only one worker succeeds in moving the stale claim away
+            stale_file = "{}.{}.stale".format(claim_file, worker_id)
+            try:
+                os.rename(claim_file, stale_file)
+            except OSError:
+                return False
+            os.remove(stale_file)
+            print("Taking over stale claim of task {} of subject {}".format(task["id"], self.subject_label))
+        try:
+            fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return False
+        with os.fdopen(fd, "w") as fi:
+            fi.write(worker_id)
+        # the task might have been finished by another worker between status() and claim()
+        if os.path.exists(self.path("done", task["name"])):
+            self.release(task)
+            return False
+        return True
+
+    def release(self, task):
+        try:
+            os.remove(self.path("claims", task["name"]))
+        except OSError:
+            pass
+
+    def set_outcome(self, task, outcome, worker_id, **fields):
+        # outcome: "done" or "failed"
+        record = {"worker": worker_id, "time": time.time()}
+        record.update(fields)
+        write_json(record, self.path(outcome, task["name"]))
+        self.release(task)
+
+    def set_finished(self):
+        with open(os.path.join(self.dir, "finished"), "w") as fi:
+            fi.write(str(time.time()))
+
+
+def get_subjects(queue_dir):
+    return sorted(d[len("sub-"):] for d in os.listdir(os.path.join(queue_dir, "subjects")) if d.startswith("sub-"))
+
+
+QUEUE_PATHS = ["bids_dir", "output_dir", "freesurfer_dir"]
+
+
+def check_queue_paths(args):
+    # raises if the queue has been planned with other paths; the tasks of a queue only work with the paths they have
+    # been planned with (the results of all workers have to end up in the same output_dir)
+    queue_file = os.path.join(args.queue_dir, "queue.json")
+    if not os.path.exists(queue_file):
+        return False
+    with open(queue_file) as fi:
+        queue = json.load(fi)
+    for name in QUEUE_PATHS:
+        if os.path.realpath(queue[name]) != os.path.realpath(getattr(args, name)):
+            raise Exception("The queue in {} has been planned with {} {}, not {}. Use the same paths for all runs "
+                            "of a queue.".format(args.queue_dir, name, queue[name], getattr(args, name)))
+    return True
+
+
+def plan_queue(args, layout, subjects_to_analyze, sessions_to_analyze):
+    """
+    writes a prepare task for each subject with enough data to queue_dir
+    subjects that are already in the queue are left as they are, so planning can be repeated to add subjects
+    """
+    truly_longitudinal_study = True if len(layout.get_sessions()) > 1 else False
+    if not os.path.exists(os.path.join(args.queue_dir, "subjects")):
+        os.makedirs(os.path.join(args.queue_dir, "subjects"))
+    if not check_queue_paths(args):
+        queue = OrderedDict((name, os.path.abspath(getattr(args, name))) for name in QUEUE_PATHS)
+        queue["time"] = time.time()
+        write_json(queue, os.path.join(args.queue_dir, "queue.json"))
+
+    n_subjects = 0
+    for subject_label in subjects_to_analyze:
+        valid_subject, valid_sessions = check_minimal_data_reqs(layout, subject_label, sessions_to_analyze)
+        if not valid_subject:
+            warn("Subject {} has not enough data to run TRACULA".format(subject_label))
+            continue
+        SubjectQueue(args.queue_dir, subject_label).add_tasks([{"id": "prepare",
+                                                                "name": "prepare",
+                                                                "stage": "prepare",
+                                                                "deps": [],
+                                                                "after_stage": None,
+                                                                "expand": "prepare",
+                                                                "cmd": None,
+                                                                "sessions": valid_sessions,
+                                                                "truly_longitudinal_study": truly_longitudinal_study,
+                                                                "stages": args.stages}])
+        n_subjects += 1
+    print("Queued {} subjects in {}. Start any number of workers with --queue_mode worker.".format(
+        n_subjects, args.queue_dir))
+
+
+def get_graph_tasks(args, subject_queue, done_task=None):
+    """
+    returns the tasks of the TracTaskGraph of a subject
+    the graph is rebuilt from the job files that have been written by the finished job file tasks (and done_task)
+    """
+    prepare = subject_queue.tasks()["prepare"]
+    subject_dir = os.path.join(args.output_dir, "sub-" + subject_queue.subject_label)
+    graph = TracTaskGraph(os.path.join(subject_dir, "jobs"), os.path.join(subject_dir, "dmrirc"), prepare["stages"])
+    for stage in TRAC_JOB_FILES.keys():
+        task_id = "jobs:" + stage
+        if task_id not in graph.tasks:
+            continue
+        task_name = get_task_name(task_id)
+        if not (done_task and done_task["name"] == task_name) and \
+                not os.path.exists(subject_queue.path("done", task_name)):
+            break
+        graph.task_done(graph.tasks[task_id])
+
+    tasks = []
+    for task in graph.tasks.values():
+        task = dict(task, name=get_task_name(task["id"]))
+        if not task["deps"] and not task["after_stage"]:
+            # the first job file task waits for freesurfer and the dmrirc file
+            task["deps"] = ["prepare"]
+        tasks.append(task)
+    return tasks
+
+
+def run_queue_task(args, layout, subject_queue, task, resource_pool, tracer):
+    # runs a task; tasks that create job files and the prepare task add the following tasks to the queue
+    subject_label = subject_queue.subject_label
+    jobs_dir = os.path.join(args.output_dir, "sub-" + subject_label, "jobs")
+    if task["id"] == "prepare":
+        run_fs_if_not_available(args, subject_label, task["sessions"], resource_pool=resource_pool, tracer=tracer)
+        if args.run_freesurfer_tests_only:
+            return
+        subject_session_info = get_subject_session_info(args, layout, subject_label, task["sessions"],
+                                                        task["truly_longitudinal_study"])
+        if not os.path.exists(jobs_dir):
+            os.makedirs(jobs_dir)
+        create_dmrirc(args.freesurfer_dir, args.output_dir, subject_label, subject_session_info)
+    else:
+        resource_pool.run_cmd(task["cmd"], cost_class=task["id"].split(":")[0], n_cmds=len(task["cmds"]),
+                              log_file=os.path.join(jobs_dir, "logs", task["name"] + ".log"), echo=False,
+                              tracer=tracer,
+                              trace_fields={"task": task["id"], "stage": task["stage"], "sessions": task["sessions"]})
+    if task["expand"]:
+        subject_queue.add_tasks(get_graph_tasks(args, subject_queue, done_task=task))
+
+
+class Heartbeat(object):
+    # touches the claim files of the running tasks of a worker every HEARTBEAT_INTERVAL seconds
+
+    def __init__(self):
+        self.claim_files = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            with self._lock:
+                claim_files = list(self.claim_files)
+            for claim_file in claim_files:
+                try:
+                    os.utime(claim_file)
+                except OSError:
+                    pass
+
+    def add(self, claim_file):
+        with self._lock:
+            self.claim_files.add(claim_file)
+
+    def remove(self, claim_file):
+        with self._lock:
+            self.claim_files.discard(claim_file)
+
+    def stop(self):
+        self._stop.set()
+
+
+def run_worker(args, layout):
+    """
+    claims and runs tasks from queue_dir until no task is left that could become ready
+    up to n_cpus tasks run at the same time. A worker continues with the subjects it is already working on and
+    otherwise takes the next unfinished subject; workers start at different subjects, so that they do not compete
+    for the same tasks.
+    """
+    if args.scratch_dir:
+        raise Exception("--scratch_dir cannot be used with --queue_dir")
+    if not check_queue_paths(args):
+        raise Exception("No queue in {}. Plan it first with --queue_mode plan.".format(args.queue_dir))
+    worker_id = "{}-{}".format(socket.gethostname(), os.getpid())
+    subject_labels = get_subjects(args.queue_dir)
+    offset = zlib.crc32(worker_id.encode("utf-8")) % max(len(subject_labels), 1)
+    subject_labels = subject_labels[offset:] + subject_labels[:offset]
+    subject_queues = OrderedDict((s, SubjectQueue(args.queue_dir, s)) for s in subject_labels)
+    finished = set()
+    active = OrderedDict()
+    tracers = {}
+
+    profile = ResourceProfile(os.path.join(args.cache_dir, "resource_profile.json"))
+    resource_pool = ResourcePool(args.n_cpus, args.mem_gb * 1024 if args.mem_gb else None, profile=profile,
+                                 retries=args.retries)
+    heartbeat = Heartbeat()
+    print("Worker {} started on {} subjects of {}".format(worker_id, len(subject_labels), args.queue_dir))
+
+    def claim_next():
+        # returns (subject_queue, task, live); subject_queue and task are None if no task could be claimed
+        # live: False if no task of any subject is running, i.e., no task can become ready anymore
+        live = False
+        for subject_label in list(active.keys()) + [s for s in subject_queues.keys() if s not in active]:
+            if subject_label in finished:
+                continue
+            subject_queue = subject_queues[subject_label]
+            if subject_queue.is_finished():
+                finished.add(subject_label)
+                continue
+            ready, live_claims, n_failed, subject_finished = subject_queue.status()
+            if subject_finished:
+                subject_queue.set_finished()
+                finished.add(subject_label)
+                active.pop(subject_label, None)
+                # timeline of all workers that ran tasks of the subject
+                jobs_dir = os.path.join(args.output_dir, "sub-" + subject_label, "jobs")
+                trace_files = glob(os.path.join(jobs_dir, "trace.*.jsonl"))
+                if trace_files:
+                    export_chrome_trace(trace_files, os.path.join(jobs_dir, "trace.json"))
+                continue
+            live = live or bool(live_claims)
+            for task, stale in ready:
+                if subject_queue.claim(task, worker_id, stale):
+                    active[subject_label] = True
+                    return subject_queue, task, True
+        return None, None, live
+
+    def run(subject_queue, task):
+        subject_label = subject_queue.subject_label
+        if subject_label not in tracers:
+            # one trace file per worker, appending to one file from several nodes is not safe on network file systems
+            tracers[subject_label] = Tracer(os.path.join(args.output_dir, "sub-" + subject_label, "jobs",
+                                                         "trace.{}.jsonl".format(worker_id)),
+                                            subject=subject_label, worker=worker_id)
+        run_queue_task(args, layout, subject_queue, task, resource_pool, tracers[subject_label])
+
+    running = {}
+    n_done, n_failed = 0, 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.n_cpus) as executor:
+            while True:
+                live = False
+                while len(running) < args.n_cpus:
+                    subject_queue, task, live = claim_next()
+                    if subject_queue is None:
+                        break
+                    print("Running task {} of subject {}".format(task["id"], subject_queue.subject_label))
+                    heartbeat.add(subject_queue.path("claims", task["name"]))
+                    running[executor.submit(run, subject_queue, task)] = (subject_queue, task)
+                if not running:
+                    if not live:
+                        break
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                finished_futures, _ = wait(running, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in finished_futures:
+                    subject_queue, task = running.pop(future)
+                    heartbeat.remove(subject_queue.path("claims", task["name"]))
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print("Task {} of subject {} failed: {}".format(task["id"], subject_queue.subject_label, e))
+                        subject_queue.set_outcome(task, "failed", worker_id, error=str(e))
+                        n_failed += 1
+                    else:
+                        subject_queue.set_outcome(task, "done", worker_id)
+                        n_done += 1
+    finally:
+        heartbeat.stop()
+        profile.save()
+
+    print("Worker {} finished: {} tasks done, {} tasks failed".format(worker_id, n_done, n_failed))
+    n_failed_all = sum(q.status()[2] for s, q in subject_queues.items() if s not in finished)
+    if n_failed_all:
+        raise Exception("%d tasks failed; see %s/subjects/*/failed" % (n_failed_all, args.queue_dir))